@@ -0,0 +1,75 @@
+# coding: utf-8
+
+"""Command line static site build without the Flask server
+
+python3 -m cmsimde build [--output DIR] [--jobs N] [--full] [--profile]
+python3 -m cmsimde rollback [--output DIR]
+
+在網站根目錄執行, 可由 cron 或 git hook 轉出靜態網頁, 不需要登入管理者
+"""
+
+import os
+import sys
+import argparse
+
+currentdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, currentdir)
+import flaskapp
+
+
+def build(args):
+
+    """Run generate_static and print the changed files, return exit status
+    """
+
+    result = flaskapp.generate_static(args.jobs, not args.full, args.output)
+    if isinstance(result, str):
+        print(result, file=sys.stderr)
+        return 1
+    for name in result["written"]:
+        print("written: " + name)
+    for name in result["deleted"]:
+        print("deleted: " + name)
+    print("%d written, %d deleted, %d unchanged in %.3f s" % (len(result["written"]), len(result["deleted"]),
+                                                             len(result["unchanged"]), result["timing"]["total"]))
+    if args.profile:
+        # 平行轉檔時各階段為所有程序的累計秒數, total 則為實際經過時間
+        for phase in result["timing"]:
+            print("%-8s %8.3f" % (phase, result["timing"][phase]))
+    return 0
+
+
+def rollback(args):
+
+    """Swap the output directory with the previous build, return exit status
+    """
+
+    if flaskapp.rollback_static(args.output):
+        print("output swapped with the previous build")
+        return 0
+    print("no previous build to roll back to", file=sys.stderr)
+    return 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 -m cmsimde", description="cmsimde static site tools")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("build", help="generate static pages")
+    command.add_argument("--output", help="output directory, default content")
+    command.add_argument("--jobs", type=int, default=getattr(flaskapp.init.Init, "generate_jobs", 1),
+                         help="worker processes, 0 uses every CPU")
+    command.add_argument("--full", action="store_true", help="ignore the build manifest and render every page")
+    command.add_argument("--profile", action="store_true", help="print seconds spent in each build phase")
+    command.set_defaults(func=build)
+    command = commands.add_parser("rollback", help="swap the output directory with the previous build")
+    command.add_argument("--output", help="output directory, default content")
+    command.set_defaults(func=rollback)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,323 @@
+# coding: utf-8
+
+"""Benchmark content.htm parsing, menus, page rendering and static generation with synthetic content
+
+python3 cmsimde/benchmark.py [pages ...] [--jobs N] [--no-memory] [--json FILE] [--compare FILE]
+python3 cmsimde/benchmark.py [pages ...] --split [--legacy]
+python3 cmsimde/benchmark.py --importtime [--runs N]
+
+預設以 100, 1000 與 10000 頁的內容在暫存目錄中量測各階段秒數與 tracemalloc 記憶體峰值,
+--json 儲存結果, --compare 與先前儲存的結果比較, --importtime 以 python -X importtime 量測 import flaskapp 的時間
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import subprocess
+
+currentdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, currentdir)
+import flaskapp
+
+# 中文標題與 Brython 程式, 用於模擬實際網站內容
+CJK_WORDS = ["課程", "作業", "網際", "內容", "管理", "系統", "設計", "協同", "產品", "專題"]
+BRYTHON = """<script type="text/python">
+from browser import document, html
+canvas = html.CANVAS(width=300, height=200)
+document["brython_div"] <= canvas
+ctx = canvas.getContext("2d")
+for i in range(10):
+    ctx.fillRect(i * 20, i * 10, 15, 15)
+</script>
+<div id="brython_div"></div>
+"""
+
+
+def generate_content(pages, seed=0):
+
+    """Return a normalized content.htm source with given number of pages
+
+    包含 h1, h2, h3 階層, 重複標題, 中文標題, 大型 pre 區塊與 Brython 程式
+    """
+
+    rand = random.Random(seed)
+    outstring = ""
+    titles = []
+    for i in range(pages):
+        # 第一個標題必須為 h1, 之後隨機產生 h1, h2, h3 階層
+        if i == 0:
+            level = 1
+        else:
+            level = rand.choice([1, 2, 2, 3])
+        if i % 10 == 9:
+            # 重複的標題在靜態網頁中依序加上 -1, -2
+            title = rand.choice(titles)
+        elif i % 3 == 2:
+            title = rand.choice(CJK_WORDS) + rand.choice(CJK_WORDS) + " " + str(i)
+        else:
+            title = "page " + str(i)
+        titles.append(title)
+        outstring += "<h" + str(level) + ">" + title + "</h" + str(level) + ">\n"
+        for j in range(rand.randint(1, 5)):
+            outstring += "<p>paragraph " + str(j) + " of page " + str(i) + " " + rand.choice(CJK_WORDS) + \
+                              " <a href=\"/get_page/page " + str(i) + "\">link</a>" + \
+                              " <img src=\"/images/" + str(i) + ".png\"/></p>\n"
+        if i % 7 == 0:
+            outstring += "<pre class=\"brush: python\">\n"
+            for j in range(rand.randint(20, 200)):
+                outstring += "for i in range(" + str(j) + "):\n    print(i, \"&lt;tag&gt;\")\n"
+            outstring += "</pre>\n"
+        if i % 11 == 0:
+            outstring += BRYTHON
+    return outstring
+
+
+def timeit(func, *args):
+
+    """Return elapsed seconds and result of func(*args)
+    """
+
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def peak_memory(func, *args):
+
+    """Return peak bytes allocated by Python while running func(*args)
+    """
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_split(pages_list, legacy=False):
+
+    """Compare split_content with the bs4 splitting for each page count
+    """
+
+    print("%8s %10s %12s %12s" % ("pages", "bytes", "split (s)", "bs4 (s)"))
+    for pages in pages_list:
+        subject = generate_content(pages)
+        elapsed, result = timeit(flaskapp.split_content, subject)
+        # bs4 切割為平方時間, 預設只比較 1000 頁以下的內容
+        if legacy or pages <= 1000:
+            legacy_elapsed, legacy_result = timeit(flaskapp._split_content_bs4, subject)
+            if legacy_result != result:
+                print("split_content result differs from bs4 splitting")
+            legacy_time = "%.3f" % legacy_elapsed
+        else:
+            legacy_time = "-"
+        print("%8d %10d %12.3f %12s" % (pages, len(subject.encode("utf-8")), elapsed, legacy_time))
+
+
+def import_report(runs=5, top=15):
+
+    """Print cold import time and memory of flaskapp in new processes and the slowest imported modules
+
+    各次於新程序中 import flaskapp, 時間與記憶體取中位數, 模組列表取自最後一次的 -X importtime 輸出
+    """
+
+    code = "import sys, time, resource; sys.path.insert(0, " + repr(currentdir) + "); start = time.perf_counter(); " + \
+           "import flaskapp; print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+    # 實際部署時已有 __pycache__, 先執行一次產生 .pyc, 不計入量測
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    seconds = []
+    memory = []
+    for i in range(runs + 1):
+        # 與啟動網站相同, 在網站根目錄 import flaskapp
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=os.path.dirname(currentdir), env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+        elapsed, maxrss = result.stdout.split()
+        if i > 0:
+            seconds.append(float(elapsed))
+            memory.append(int(maxrss))
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative_us), int(self_us), len(name) - len(name.lstrip()), name.strip()))
+    print("import flaskapp %.3f s, max rss %.1f MB (median of %d runs)" % (sorted(seconds)[runs // 2],
+                                                                           sorted(memory)[runs // 2] / 1024.0, runs))
+    # importtime 先列出子模組再列出 import 它們的模組, flaskapp 之前縮排較深的各行為其匯入的模組
+    end = [module[3] for module in modules].index("flaskapp")
+    start = end
+    while start > 0 and modules[start - 1][2] > modules[end][2]:
+        start -= 1
+    children = [module for module in modules[start:end] if module[2] == modules[end][2] + 2]
+    print("%10s %10s  %s" % ("cumulative", "self", "module imported by flaskapp (ms)"))
+    for cumulative, self_us, indent, name in [modules[end]] + sorted(children, reverse=True)[:top]:
+        print("%10.1f %10.1f  %s" % (cumulative / 1000.0, self_us / 1000.0, name))
+    print("%10s %10s  %s" % ("cumulative", "self", "slowest modules by self time (ms)"))
+    for cumulative, self_us, indent, name in sorted(modules, key=lambda module: -module[1])[:top]:
+        print("%10.1f %10.1f  %s" % (cumulative / 1000.0, self_us / 1000.0, name))
+
+
+def use_site(site_dir):
+
+    """Point flaskapp at the config directory of a temporary site
+    """
+
+    flaskapp.config_dir = os.path.join(site_dir, "config") + "/"
+    # 固定使用 content.htm, 不受 init.py 的 content_store 設定影響
+    flaskapp.content_store = "htm"
+    flaskapp._page_store["store"] = None
+    os.makedirs(flaskapp.config_dir, exist_ok=True)
+    with open(flaskapp.config_dir + "sitetitle", "w", encoding="utf-8") as f:
+        f.write("benchmark")
+    flaskapp.bump_content_version()
+
+
+def write_content(site_dir, subject):
+    with open(os.path.join(site_dir, "config", "content.htm"), "w", encoding="utf-8") as f:
+        f.write(subject)
+    flaskapp.bump_content_version()
+
+
+def site_phases(site_dir, subject, jobs):
+
+    """Return list of (phase name, items, function) measured for one synthetic site
+    """
+
+    output_dir = os.path.join(site_dir, "content")
+    edits = [0]
+
+    def snapshot():
+        flaskapp.bump_content_version()
+        return flaskapp.content_snapshot()
+
+    def menu(render):
+        def run():
+            current = flaskapp.content_snapshot()
+            # 清除 snapshot 中的選單快取, 量測實際產生選單的時間
+            current.menus.clear()
+            render(current.unique_head, current.level, current.page)
+        return run
+
+    def pages():
+        current = flaskapp.content_snapshot()
+        flaskapp.page_cache.clear()
+        for heading in current.unique_head[:200]:
+            flaskapp.get_page2(heading, current.unique_head, 0, snapshot=current)
+
+    def edit():
+        # 每次修改一個頁面的段落, 增量轉檔只需重新產生少數檔案
+        edits[0] += 1
+        write_content(site_dir, subject.replace("paragraph 0 of page 1 ", "paragraph 0 of page 1 edit " + str(edits[0]) + " ", 1))
+        return flaskapp.generate_static(jobs, True, output_dir)
+
+    heads = flaskapp.content_snapshot().unique_head
+    return [("split", len(heads), lambda: flaskapp.split_content(subject)),
+            ("snapshot", len(heads), snapshot),
+            ("render_menu", len(heads), menu(flaskapp.render_menu)),
+            ("render_menu2", len(heads), menu(flaskapp.render_menu2)),
+            ("render_menu3", len(heads), menu(flaskapp.render_menu3)),
+            ("get_page2", min(len(heads), 200), pages),
+            ("generate_full", len(heads), lambda: flaskapp.generate_static(jobs, False, output_dir)),
+            ("generate_noop", len(heads), lambda: flaskapp.generate_static(jobs, True, output_dir)),
+            ("generate_edit", len(heads), edit)]
+
+
+def bench_site(pages, jobs=1, memory=True):
+
+    """Return dict of seconds and peak memory of each phase for a synthetic site with given pages
+    """
+
+    subject = generate_content(pages)
+    site_dir = tempfile.mkdtemp(prefix="cmsimde_benchmark_")
+    try:
+        use_site(site_dir)
+        write_content(site_dir, subject)
+        phases = {}
+        for name, items, func in site_phases(site_dir, subject, jobs):
+            elapsed, result = timeit(func)
+            phases[name] = {"seconds": elapsed, "items": items}
+            # tracemalloc 會拖慢執行, 記憶體峰值另外執行一次量測
+            if memory:
+                phases[name]["peak_bytes"] = peak_memory(func)
+            print("%8d %-14s %10.3f %12s" % (pages, name, elapsed,
+                                              "%.1f MB" % (phases[name]["peak_bytes"] / 1048576.0) if memory else "-"))
+        return {"pages": pages, "bytes": len(subject.encode("utf-8")), "phases": phases}
+    finally:
+        shutil.rmtree(site_dir, ignore_errors=True)
+
+
+def git_commit():
+
+    """Return the current git commit of the cmsimde directory, None outside a git checkout
+    """
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=currentdir,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, filename):
+
+    """Print the ratio of each phase against results saved in filename
+    """
+
+    with open(filename, encoding="utf-8") as f:
+        old = json.load(f)
+    old_results = dict((site["pages"], site) for site in old["results"])
+    print("compared with " + str(old.get("commit")))
+    print("%8s %-14s %10s %10s %8s" % ("pages", "phase", "old (s)", "new (s)", "ratio"))
+    for site in results:
+        if site["pages"] not in old_results:
+            continue
+        for name, phase in site["phases"].items():
+            old_phase = old_results[site["pages"]]["phases"].get(name)
+            if old_phase is None:
+                continue
+            ratio = phase["seconds"] / old_phase["seconds"] if old_phase["seconds"] else float("inf")
+            print("%8d %-14s %10.3f %10.3f %7.2fx" % (site["pages"], name, old_phase["seconds"], phase["seconds"], ratio))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python3 cmsimde/benchmark.py", description="cmsimde synthetic content benchmark")
+    parser.add_argument("pages", nargs="*", type=int, help="pages of each synthetic site, default 100 1000 10000")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes of static generation, default 1")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip tracemalloc peak memory")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--compare", help="compare with results saved by --json")
+    parser.add_argument("--split", action="store_true", help="time page splitting only, default 1000 10000 pages")
+    parser.add_argument("--legacy", action="store_true", help="also time the legacy splitter with --split")
+    parser.add_argument("--importtime", action="store_true", help="time import flaskapp with python -X importtime")
+    parser.add_argument("--runs", type=int, default=5, help="runs of --importtime, default 5")
+    # 頁數可以放在選項之前或之後
+    args = parser.parse_intermixed_args(argv)
+    if args.split:
+        bench_split(args.pages or [1000, 10000], args.legacy)
+        return 0
+    if args.importtime:
+        import_report(args.runs)
+        return 0
+    print("%8s %-14s %10s %12s" % ("pages", "phase", "seconds", "peak memory"))
+    results = [bench_site(pages, args.jobs, args.memory) for pages in args.pages or [100, 1000, 10000]]
+    report = {"commit": git_commit(), "python": platform.python_version(), "platform": platform.platform(),
+              "time": time.strftime("%Y-%m-%d %H:%M:%S"), "jobs": args.jobs, "results": results}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,605 @@
+# coding: utf-8
+
+"""Page storage backends used instead of config/content.htm and the edit journal
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+import html.parser
+
+import metrics
+
+
+def write_file(filename, data):
+
+    """Write data into filename through a temporary file and os.replace
+    """
+
+    temp = filename + ".tmp"
+    with open(temp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(temp, filename)
+    metrics.registry.inc("cmsimde_file_writes_total")
+    metrics.registry.inc("cmsimde_file_write_bytes_total", len(data))
+
+
+class JSONListWriter(object):
+
+    """Write a JSON list item by item into filename through a temporary file
+
+    prefix 與 suffix 包住整個 list, close() 傳回輸出內容的 sha1, 之後以 commit() 或 discard() 結束
+    """
+
+    def __init__(self, filename, prefix="", suffix=""):
+        self.filename = filename
+        self.suffix = suffix
+        self.count = 0
+        self.bytes = 0
+        self.digest = hashlib.sha1()
+        self.file = open(filename + ".tmp", "w", encoding="utf-8")
+        self._write(prefix + "[")
+
+    def _write(self, data):
+        self.file.write(data)
+        self.bytes += len(data)
+        self.digest.update(data.encode("utf-8"))
+
+    def write(self, item):
+
+        """Serialize one item, keys keep their insertion order so the output is the same between runs
+        """
+
+        data = json.dumps(item, ensure_ascii=False, separators=(", ", ": "))
+        # U+2028 與 U+2029 在舊版 javascript 字串中視為換行
+        data = data.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+        if self.count:
+            data = ", " + data
+        self._write(data)
+        self.count += 1
+
+    def close(self):
+
+        """Finish the list and return sha1 hex digest of the whole output
+        """
+
+        self._write("]" + self.suffix)
+        self.file.close()
+        return self.digest.hexdigest()
+
+    def commit(self):
+        os.replace(self.filename + ".tmp", self.filename)
+        metrics.registry.inc("cmsimde_file_writes_total")
+        metrics.registry.inc("cmsimde_file_write_bytes_total", self.bytes)
+
+    def discard(self):
+        os.remove(self.filename + ".tmp")
+
+
+class TextExtractor(html.parser.HTMLParser):
+
+    """Collect visible text of page html for search
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style") and self.skip > 0:
+            self.skip -= 1
+
+    def handle_data(self, data):
+        if self.skip == 0:
+            self.text.append(data)
+
+
+def page_text(html):
+
+    """Return visible text of page html
+    """
+
+    extractor = TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return " ".join(" ".join(extractor.text).split())
+
+
+class ShardStore(object):
+
+    """Keep each page in its own file under config/pages with an ordered manifest
+
+    manifest.json 依序記錄各頁面的 heading, level, 原始標題標註 tag 與頁面檔案 file
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_file = os.path.join(directory, "manifest.json")
+
+    def exists(self):
+
+        """Check if pages were imported into this store
+        """
+
+        return os.path.isfile(self.manifest_file)
+
+    def key(self):
+
+        """Return the stat values that change whenever a page is saved
+        """
+
+        # 頁面檔案以 os.replace 寫入, 目錄的 mtime 會隨每次存檔改變
+        dir_stat = os.stat(self.directory)
+        stat = os.stat(self.manifest_file)
+        return (dir_stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def read_manifest(self):
+
+        """Return manifest dict
+        """
+
+        with open(self.manifest_file, encoding="utf-8") as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest):
+
+        """Write manifest dict
+        """
+
+        write_file(self.manifest_file, json.dumps(manifest, ensure_ascii=False, indent=1))
+
+    def read_page(self, filename):
+
+        """Return page content of filename
+        """
+
+        with open(os.path.join(self.directory, filename), encoding="utf-8") as f:
+            return f.read()
+
+    def write_page(self, filename, html, backup=True):
+
+        """Write page content, keep the previous version as filename.bak
+        """
+
+        path = os.path.join(self.directory, filename)
+        if backup and os.path.isfile(path):
+            shutil.copy2(path, path + ".bak")
+        write_file(path, html)
+
+    def remove_page(self, filename):
+
+        """Remove page file and its backup
+        """
+
+        path = os.path.join(self.directory, filename)
+        for name in [path, path + ".bak"]:
+            if os.path.isfile(name):
+                os.remove(name)
+
+    def new_entry(self, manifest, heading, level, tag, html):
+
+        """Write html into a new page file and return its manifest entry
+        """
+
+        # 檔名取自遞增的 next_id, 插入頁面時不必重新命名其他頁面檔案
+        filename = str(manifest["next_id"]) + ".htm"
+        manifest["next_id"] += 1
+        self.write_page(filename, html, backup=False)
+        return {"heading": heading, "level": level, "tag": tag, "file": filename}
+
+    def load(self):
+
+        """Return head, level, page and heading tag lists
+        """
+
+        manifest = self.read_manifest()
+        head = []
+        level = []
+        page = []
+        tag = []
+        for entry in manifest["pages"]:
+            head.append(entry["heading"])
+            level.append(entry["level"])
+            page.append(self.read_page(entry["file"]))
+            tag.append(entry["tag"])
+        return head, level, page, tag
+
+    def export(self):
+
+        """Return all pages in content.htm format
+        """
+
+        manifest = self.read_manifest()
+        return "".join(entry["tag"] + self.read_page(entry["file"]) for entry in manifest["pages"])
+
+    def save_all(self, pages):
+
+        """Replace all pages, pages are (heading, level, tag, html) tuples
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        if self.exists():
+            old_manifest = self.read_manifest()
+        else:
+            old_manifest = {"next_id": 1, "pages": []}
+        manifest = {"next_id": old_manifest["next_id"], "pages": []}
+        for heading, level, tag, page_html in pages:
+            manifest["pages"].append(self.new_entry(manifest, heading, level, tag, page_html))
+        self.write_manifest(manifest)
+        for entry in old_manifest["pages"]:
+            self.remove_page(entry["file"])
+
+    def replace_page(self, order, prefix, pages):
+
+        """Replace the page at order with pages, prefix is appended to the previous page
+
+        只寫入有改變的頁面檔案, 標題有變動時才改寫 manifest
+        """
+
+        manifest = self.read_manifest()
+        entries = manifest["pages"]
+        old_entry = entries[order]
+        if prefix:
+            # 第一個標題之前的內容屬於上一頁
+            previous = entries[order - 1]
+            self.write_page(previous["file"], self.read_page(previous["file"]) + prefix)
+        if len(pages) == 0:
+            del entries[order]
+            self.write_manifest(manifest)
+            self.remove_page(old_entry["file"])
+            return
+        heading, level, tag, page_html = pages[0]
+        self.write_page(old_entry["file"], page_html)
+        if len(pages) == 1 and tag == old_entry["tag"]:
+            return
+        new_entries = [{"heading": heading, "level": level, "tag": tag, "file": old_entry["file"]}]
+        for heading, level, tag, page_html in pages[1:]:
+            new_entries.append(self.new_entry(manifest, heading, level, tag, page_html))
+        entries[order:order+1] = new_entries
+        self.write_manifest(manifest)
+
+
+class SQLiteStore(object):
+
+    """Keep pages in config/content.db with an FTS5 index over the page text
+
+    使用 WAL 模式, 讓 waitress 多執行緒讀取時不會互相等待
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # sqlite3 connection 不可跨執行緒使用, 每個執行緒各自連線
+        self.local = threading.local()
+        self.fts = None
+
+    def connect(self):
+
+        """Return the connection of current thread, create tables if needed
+        """
+
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            return conn
+        # 預設的 content.htm 不需要 sqlite3, 使用 SQLiteStore 時才 import
+        import sqlite3
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # SQLite 的 lower() 只轉換 ASCII 字元, 以 Python 的 lower() 與 content.htm 的搜尋一致
+        conn.create_function("python_lower", 1, lambda value: value.lower() if isinstance(value, str) else value,
+                             deterministic=True)
+        conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+            id INTEGER PRIMARY KEY, ord INTEGER NOT NULL, heading TEXT, level TEXT,
+            tag TEXT, html TEXT, text TEXT)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS pages_ord ON pages (ord)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        conn.execute("INSERT OR IGNORE INTO meta VALUES ('generation', 0)")
+        try:
+            # trigram tokenizer 可以搜尋中文等沒有空白分隔的字串
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS pages_fts USING fts5(heading, text, tokenize='trigram')")
+            self.fts = True
+        except sqlite3.OperationalError:
+            # 沒有 FTS5 或 trigram 的 sqlite 版本改用 instr 逐頁比對
+            self.fts = False
+        conn.commit()
+        self.local.conn = conn
+        return conn
+
+    def exists(self):
+
+        """Check if pages were imported into this store
+        """
+
+        if not os.path.isfile(self.filename):
+            return False
+        return self.connect().execute("SELECT count(*) FROM pages").fetchone()[0] > 0
+
+    def key(self):
+
+        """Return the last modified time and the generation number increased on every save
+        """
+
+        stat = os.stat(self.filename)
+        mtime = stat.st_mtime_ns
+        # WAL 模式下寫入先進入 content.db-wal, 直到 checkpoint 才改變 content.db
+        if os.path.isfile(self.filename + "-wal"):
+            mtime = max(mtime, os.stat(self.filename + "-wal").st_mtime_ns)
+        return (mtime, self.connect().execute("SELECT value FROM meta WHERE name = 'generation'").fetchone()[0])
+
+    def load(self):
+
+        """Return head, level, page and heading tag lists
+        """
+
+        head = []
+        level = []
+        page = []
+        tag = []
+        for heading, page_level, page_html, page_tag in self.connect().execute(
+                "SELECT heading, level, html, tag FROM pages ORDER BY ord"):
+            head.append(heading)
+            level.append(page_level)
+            page.append(page_html)
+            tag.append(page_tag)
+        return head, level, page, tag
+
+    def export(self):
+
+        """Return all pages in content.htm format
+        """
+
+        return "".join(tag + page_html for tag, page_html in
+                            self.connect().execute("SELECT tag, html FROM pages ORDER BY ord"))
+
+    def insert(self, conn, order, heading, level, tag, html):
+
+        """Insert one page and its search text
+        """
+
+        text = page_text(html)
+        cursor = conn.execute("INSERT INTO pages (ord, heading, level, tag, html, text) VALUES (?, ?, ?, ?, ?, ?)",
+                                        (order, heading, level, tag, html, text))
+        if self.fts:
+            conn.execute("INSERT INTO pages_fts (rowid, heading, text) VALUES (?, ?, ?)",
+                               (cursor.lastrowid, heading, text))
+
+    def delete(self, conn, page_id):
+
+        """Delete one page and its search text
+        """
+
+        conn.execute("DELETE FROM pages WHERE id = ?", (page_id,))
+        if self.fts:
+            conn.execute("DELETE FROM pages_fts WHERE rowid = ?", (page_id,))
+
+    def save_all(self, pages):
+
+        """Replace all pages, pages are (heading, level, tag, html) tuples
+        """
+
+        conn = self.connect()
+        with conn:
+            conn.execute("DELETE FROM pages")
+            if self.fts:
+                conn.execute("DELETE FROM pages_fts")
+            for order, (heading, level, tag, page_html) in enumerate(pages):
+                self.insert(conn, order, heading, level, tag, page_html)
+            conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+
+    def replace_page(self, order, prefix, pages):
+
+        """Replace the page at order with pages, prefix is appended to the previous page
+        """
+
+        conn = self.connect()
+        with conn:
+            if prefix:
+                previous_id, page_html = conn.execute("SELECT id, html FROM pages WHERE ord = ?", (order - 1,)).fetchone()
+                conn.execute("UPDATE pages SET html = ?, text = ? WHERE id = ?",
+                                   (page_html + prefix, page_text(page_html + prefix), previous_id))
+                if self.fts:
+                    conn.execute("UPDATE pages_fts SET text = ? WHERE rowid = ?", (page_text(page_html + prefix), previous_id))
+            page_id = conn.execute("SELECT id FROM pages WHERE ord = ?", (order,)).fetchone()[0]
+            self.delete(conn, page_id)
+            # 之後各頁面的次序依新增頁數位移
+            shift = len(pages) - 1
+            if shift != 0:
+                conn.execute("UPDATE pages SET ord = ord + ? WHERE ord > ?", (shift, order))
+            for i, (heading, level, tag, page_html) in enumerate(pages):
+                self.insert(conn, order + i, heading, level, tag, page_html)
+            conn.execute("UPDATE meta SET value = value + 1 WHERE name = 'generation'")
+
+    def search(self, keyword):
+
+        """Return (page order, heading) of pages matching keyword
+        """
+
+        conn = self.connect()
+        keyword = keyword.lower()
+        # trigram 索引只能搜尋三個字元以上的字串
+        if self.fts and len(keyword) >= 3:
+            rows = conn.execute("""SELECT pages.ord, pages.heading FROM pages_fts
+                JOIN pages ON pages.id = pages_fts.rowid
+                WHERE pages_fts MATCH ? ORDER BY pages.ord""",
+                ('"' + keyword.replace('"', '""') + '"',))
+        else:
+            rows = conn.execute("""SELECT ord, heading FROM pages
+                WHERE instr(python_lower(heading), ?) > 0 OR instr(python_lower(text), ?) > 0 ORDER BY ord""",
+                (keyword, keyword))
+        return rows.fetchall()
+
+
+def text_delta(old, new):
+
+    """Return (offset, removed, inserted) turning old into new
+
+    以二分法比較共同前後綴, 字串比較在 C 中進行, 不必逐字元迴圈
+    """
+
+    low, high = 0, min(len(old), len(new))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[low:middle] == new[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    prefix = low
+    low, high = 0, min(len(old), len(new)) - prefix
+    while low < high:
+        middle = (low + high + 1) // 2
+        if old[len(old)-middle:len(old)-low] == new[len(new)-middle:len(new)-low]:
+            low = middle
+        else:
+            high = middle - 1
+    suffix = low
+    return prefix, old[prefix:len(old)-suffix], new[prefix:len(new)-suffix]
+
+
+def text_hash(text):
+
+    """Return sha1 hex digest of text
+    """
+
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class Journal(object):
+
+    """Append-only edit journal, one JSON line for each content change
+
+    各行記錄 time, page, offset (於 content.htm 格式中的字元位置), old, new 與 old_hash, new_hash
+    存檔時只附加一行, 不再複製整個 content.htm, 超過 2 * keep 筆時壓縮為最後 keep 筆
+    """
+
+    def __init__(self, filename, keep=200, fsync_interval=1.0):
+        self.filename = filename
+        self.keep = keep
+        # 同一時間內的多次存檔合併為一次 fsync
+        self.fsync_interval = fsync_interval
+        self.lock = threading.RLock()
+        self.file = None
+        self.count = 0
+        self.last_sync = 0.0
+        self.timer = None
+
+    def open(self):
+
+        """Return journal file opened for appending
+        """
+
+        if self.file is None:
+            self.count = len(self.read())
+            self.file = open(self.filename, "a", encoding="utf-8")
+        return self.file
+
+    def read(self):
+
+        """Return journal entries, oldest first
+        """
+
+        entries = []
+        if not os.path.isfile(self.filename):
+            return entries
+        with open(self.filename, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # 寫入中斷留下的不完整行
+                    pass
+        return entries
+
+    def append(self, page, offset, old, new):
+
+        """Append one change and return the journal entry
+        """
+
+        entry = {"time": time.time(), "page": page, "offset": offset, "old": old, "new": new,
+                     "old_hash": text_hash(old), "new_hash": text_hash(new)}
+        with self.lock:
+            f = self.open()
+            data = json.dumps(entry, ensure_ascii=False) + "\n"
+            f.write(data)
+            f.flush()
+            # 附加寫入不經過 write_file, 另行計入寫檔次數
+            metrics.registry.inc("cmsimde_file_writes_total")
+            metrics.registry.inc("cmsimde_file_write_bytes_total", len(data))
+            self.count += 1
+            if time.monotonic() - self.last_sync >= self.fsync_interval:
+                self.sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.fsync_interval, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+            if self.count > 2 * self.keep:
+                self.compact()
+        return entry
+
+    def sync(self):
+
+        """Flush pending entries to disk
+        """
+
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.last_sync = time.monotonic()
+
+    def close(self):
+
+        """Sync and close journal file
+        """
+
+        with self.lock:
+            self.sync()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def rewrite(self, entries):
+
+        """Replace journal file with entries
+        """
+
+        with self.lock:
+            self.close()
+            write_file(self.filename, "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries))
+            self.count = len(entries)
+
+    def compact(self, keep=None):
+
+        """Drop all but the newest keep entries, return number of dropped entries
+        """
+
+        if keep is None:
+            keep = self.keep
+        with self.lock:
+            entries = self.read()
+            dropped = max(len(entries) - keep, 0)
+            if dropped > 0:
+                self.rewrite(entries[dropped:])
+            return dropped
+
+    def pop(self):
+
+        """Remove and return the newest entry, None if journal is empty
+        """
+
+        with self.lock:
+            entries = self.read()
+            if len(entries) == 0:
+                return None
+            self.rewrite(entries[:-1])
+            return entries[-1]
@@ -14,37 +14,44 @@ from nocache import nocache
 import re
 import math
 import hashlib
+import hmac
 # use quote_plus() to generate URL
 import urllib.parse
 # use cgi.escape() to resemble php htmlspecialchars()
 # use cgi.escape() or html.escape to generate data for textarea tag, otherwise Editor can not deal with some Javascript code.
 # for python 3.8 import html to replace cgi
 from html import escape as html_escape
+# for split_content function
+import html.parser
 #import cgi
 import os
 import sys
-# for new parse_content function
-# 為了使用 bs4.element, 改為 import bs4
-import bs4
 # for ssavePage and savePage
 import shutil
-# for merge_sequence
-from difflib import SequenceMatcher
 import inspect
-# 針對單一頁面有許多 html 標註時, 增大遞迴圈數設定
-sys.setrecursionlimit(1000000)
 
 # get the parent directory of the file
 currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir) 
+# 與 wsgi.py 相同, 讓 cmsimde 目錄中的模組可以直接 import
+sys.path.append(currentdir)
 _curdir = os.path.join(os.getcwd(), parentdir)
 import init
-# for start_static function
-#import os
-import subprocess
+# for page store backends
+import contentstore
+# for rendered page cache
+import pagecache
+# for request timing and /metrics
+import metrics
+# for admin triggered request profiling
+import profiler
 import threading
-import http.server, ssl
+# for content journal
+import time
+import atexit
+# for build manifest
+import json
 
 try:
     # 新增 user.py 使用者自訂延伸程式功能, 先前版本若要升級至新版本, 必須新增 user.py 檔案
@@ -57,8 +64,6 @@ import string
 
 # for start_static to get wan address
 import socket
-# for start_static to use https
-import ssl
 from pathlib import Path
 
 # 由 init.py 中的 uwsgi = False 或 True 決定在 uwsgi 模式或近端模式執行
@@ -76,10 +81,21 @@ uwsgi = init.Init.uwsgi
 ip = init.Init.ip
 dynamic_port = init.Init.dynamic_port
 static_port = init.Init.static_port
+# 頁面儲存方式, "htm" 為 config/content.htm, "shard" 則將各頁面分存於 config/pages/, "sqlite" 為 config/content.db
+content_store = getattr(init.Init, "content_store", "htm")
+# 各次存檔附加於 config/content_journal.jsonl, 保留最後 journal_keep 筆可以 undo 的修改
+journal = contentstore.Journal(config_dir + "content_journal.jsonl", getattr(init.Init, "journal_keep", 200))
+atexit.register(journal.close)
+# 已產生頁面內容的 LRU 快取, page_cache_size 為快取使用的記憶體上限 (bytes)
+page_cache = pagecache.PageCache(getattr(init.Init, "page_cache_size", 32 * 1024 * 1024))
+# 管理者於 /profiles 指定要剖析的 request, 結果存於 profiles/ 目錄
+request_profiler = profiler.Profiler(_curdir + "/profiles/")
 
 # 必須先將 download_dir 設為 static_folder, 然後才可以用於 download 方法中的 app.static_folder 的呼叫
 app = Flask(__name__)
 CORS(app, support_credentials=False)
+# 記錄各 route 的 request 次數與秒數, init.py 的 metrics 可設為 "off", "basic" 或 "full"
+metrics.install(app, getattr(init.Init, "metrics", "basic"))
 
 # 設置隨後要在 blueprint 應用程式中引用的 global 變數
 app.config['config_dir'] = config_dir
@@ -292,11 +308,18 @@ def doSearch():
         head, level, page = parse_content()
         directory = render_menu(head, level, page)
         match = ""
-        for index in range(len(head)):
-            if (keyword != "" or None) and (keyword.lower() in page[index].lower() or \
-            keyword.lower() in head[index].lower()): \
-                match += "<a href='/get_page/" + head[index] + "'>" + \
-                                head[index] + "</a><br />"
+        store = page_store()
+        if keyword != "" and hasattr(store, "search"):
+            # sqlite 頁面儲存以 FTS5 索引搜尋, 不必逐頁比對
+            for order, heading in store.search(keyword):
+                match += "<a href='/get_page/" + heading + "'>" + \
+                                heading + "</a><br />"
+        else:
+            for index in range(len(head)):
+                if (keyword != "" or None) and (keyword.lower() in page[index].lower() or \
+                keyword.lower() in head[index].lower()): \
+                    match += "<a href='/get_page/" + head[index] + "'>" + \
+                                    head[index] + "</a><br />"
         return set_css() + "<div class='container'><nav>"+ \
                    directory + "</nav><section><h1>Search Result</h1>keyword: " + \
                    keyword.lower() + "<br /><br />in the following pages:<br /><br />" + \
@@ -573,7 +596,7 @@ def edit_page(edit):
     else:
         head, level, page = parse_content()
         directory = render_menu(head, level, page)
-        pagedata =file_get_contents(config_dir + "content.htm")
+        pagedata = content_source()
         #outstring = tinymce_editor(directory, cgi.escape(pagedata))
         # for python 3.8
         outstring = tinymce_editor(directory, html_escape(pagedata))
@@ -936,69 +959,375 @@ def generate_pages():
     if not isAdmin():
         return redirect('/login')
     else:
+        # spawn 的子程序會重新執行啟動伺服器的 main.py 等主程式, 在 request 中只以本程序轉檔
+        build = generate_static(1)
+        if isinstance(build, str):
+            return build
         head, level, page = parse_content()
         directory = render_menu(head, level, page)
-        # 處理重複標題 head 數列， 重複標題則按照次序加上 1, 2, 3...
-        newhead = []
-        for i, v in enumerate(head):
-            # 各重複標題總數
-            totalcount = head.count(v)
-            # 目前重複標題出現總數
-            count = head[:i].count(v)
-            # 針對重複標題者, 附加目前重複標題出現數 +1, 未重複採原標題
-            newhead.append(v + "-" + str(count + 1) if totalcount > 1 else v)
-        # 刪除 content 目錄中所有 html 檔案
-        filelist = [ f for f in os.listdir(_curdir + "/content/") if f.endswith(".html") ]
-        for f in filelist:
-            os.remove(os.path.join(_curdir + "/content/", f))
-        # 這裡需要建立專門寫出 html 的 write_page
-        # index.html
-        with open(_curdir + "/content/index.html", "w", encoding="utf-8") as f:
-            f.write(get_page2(None, newhead, 0))
-        # sitemap
-        with open(_curdir + "/content/sitemap.html", "w", encoding="utf-8") as f:
-            # 為了修改為動態與靜態網頁雙向轉檔, 這裡需要 newhead pickle
-            # sitemap2 需要 newhead
-            f.write(sitemap2(newhead))
-        # 以下轉檔, 改用 newhead 數列
-
-        def visible(element):
-            if element.parent.name in ['style', 'script', '[document]', 'head', 'title']:
-                return False
-            elif re.match('<!--.*-->', str(element.encode('utf-8'))):
-                return False
-            return True
-
-        search_content = []
-        # generate each page html under content directory
-        for i in range(len(newhead)):
-            # 在此必須要將頁面中的 /images/ 字串換為 images/, /downloads/ 換為 downloads/
-            # 因為 Flask 中靠 /images/ 取檔案, 但是一般 html 則採相對目錄取檔案
-            # 此一字串置換在 get_page2 中進行
-            # 加入 tipue search 模式
-            get_page_content = []
-            html_doc = get_page2(newhead[i], newhead, 0, get_page_content)
-            """
-            # html = "<meta property='head' content='H1'>"
-            soup = BeautifulSoup(html)
-            title = soup.find("meta", property="head")
-            print(title["content"])
-            """
-            html_doc = html_doc.replace('<meta charset="utf-8">', '<meta charset="utf-8">\n<meta property="head" content="H'+str(level[i])+'">')
-            soup = bs4.BeautifulSoup(" ".join(get_page_content), "lxml")
-            search_content.append({"title": newhead[i], "text": " ".join(filter(visible, soup.findAll(text=True))), "tags": "", "url": newhead[i] + ".html"})
-            with open(_curdir + "/content/" + newhead[i] + ".html", "w", encoding="utf-8") as f:
-                # 增加以 newhead 作為輸入
-                f.write(html_doc)
-        # GENERATE js file
-        with open(_curdir + "/content/tipuesearch_content.js", "w", encoding="utf-8") as f:
-            f.write("var tipuesearch = {\"pages\": " + str(search_content) + "};")
         return set_css() + "<div class='container'><nav>" + \
                      directory + "</nav><section><h1>Generate Pages</h1>" + \
                      "已經將網站轉為靜態網頁!" + \
+                     "<br /><br />" + build_report(build) + \
                      "</section></div></body></html>"
 
 
+def generate_static(jobs=1, incremental=True, output_dir=None):
+
+    """Write static html files of all pages into content directory
+
+    jobs 大於 1 時以 multiprocessing 分散各頁面的轉檔與搜尋文字擷取, 0 表示使用全部 CPU,
+    子程序會重新執行主程式, 只能由 python3 -m cmsimde build 等有 __main__ 保護的主程式使用
+    incremental 時依 config/build_manifest.json 只轉換輸入改變的頁面, 只寫入輸出改變的檔案
+    各檔案先寫入 content_staging, 完成後才與 content 目錄交換, 上一版保留為 content_previous
+    output_dir 可指定 content 以外的輸出目錄, 頁面中 ./../ 開頭的相對路徑仍以網站根目錄為準
+    傳回 timing (各階段秒數), written, deleted 與 unchanged 檔案清單, 沒有內容時傳回錯誤訊息
+    """
+
+    timing = {"parse": 0.0, "menu": 0.0, "render": 0.0, "write": 0.0, "search": 0.0}
+    build_start = time.perf_counter()
+    start = time.perf_counter()
+    # 所有頁面共用同一個 snapshot, 不再逐頁讀取 content.htm
+    snapshot = content_snapshot()
+    if isinstance(snapshot, str):
+        return snapshot
+    level, page = snapshot.level, snapshot.page
+    # 重複標題已在 snapshot 中依序加上 1, 2, 3...
+    newhead = snapshot.unique_head
+    timing["parse"] += time.perf_counter() - start
+    start = time.perf_counter()
+    # 選單只產生一次, 之後各頁面由 snapshot 取得相同內容
+    menu = render_menu2(newhead, level, page)
+    render_menu3(newhead, level, page, sitemap=1)
+    timing["menu"] += time.perf_counter() - start
+    start = time.perf_counter()
+    if output_dir is None:
+        output_dir = _curdir + "/content"
+    output_dir = os.path.abspath(output_dir)
+    content_dir = _prepare_staging(output_dir) + "/"
+    manifest_file = build_manifest_file(output_dir)
+    if incremental:
+        manifest = read_build_manifest(manifest_file)
+    else:
+        manifest = {"code": None, "pages": {}, "files": {}}
+    # 選單, 選單模式或程式改變時, 所有頁面都必須重新轉換
+    static_menu = getattr(init.Init, "static_menu", "inline")
+    common = contentstore.text_hash(static_menu + menu + file_get_contents(os.path.abspath(__file__)))
+    if manifest["code"] != common:
+        manifest["pages"] = {}
+    new_manifest = {"code": common, "pages": {}, "files": {}}
+    build = {"timing": timing, "written": [], "deleted": [], "unchanged": []}
+    # 刪除不再屬於網站的 html 檔案 (content_staging 中的連結)
+    filenames = set(name + ".html" for name in newhead) | set(["index.html", "sitemap.html"])
+    if static_menu == "external":
+        menu_name = static_menu_file(newhead, level, page)
+        filenames.add(menu_name)
+    for f in os.listdir(content_dir):
+        if (f.endswith(".html") or f.startswith("menu-") and f.endswith(".js")) and f not in filenames:
+            os.remove(os.path.join(content_dir, f))
+            build["deleted"].append(f)
+    timing["write"] += time.perf_counter() - start
+    if static_menu == "external":
+        _write_static_file(content_dir, menu_name, static_menu_script(newhead, level, page), manifest, new_manifest, build, timing)
+    # 這裡需要建立專門寫出 html 的 write_page
+    # index.html
+    start = time.perf_counter()
+    html_doc = get_page2(None, newhead, 0, snapshot=snapshot)
+    timing["render"] += time.perf_counter() - start
+    _write_static_file(content_dir, "index.html", html_doc, manifest, new_manifest, build, timing)
+    # sitemap
+    start = time.perf_counter()
+    # 為了修改為動態與靜態網頁雙向轉檔, 這裡需要 newhead pickle
+    # sitemap2 需要 newhead
+    html_doc = sitemap2(newhead, snapshot)
+    timing["render"] += time.perf_counter() - start
+    _write_static_file(content_dir, "sitemap.html", html_doc, manifest, new_manifest, build, timing)
+    # 以下轉檔, 改用 newhead 數列
+    start = time.perf_counter()
+    results = [None] * len(newhead)
+    jobs_list = []
+    for i in range(len(newhead)):
+        name = newhead[i] + ".html"
+        previous_head, next_head = snapshot.unique_neighbours[i]
+        inputs = contentstore.text_hash(repr((level[i], previous_head, next_head, page[i])))
+        old = manifest["pages"].get(name)
+        if old is not None and old["input"] == inputs and os.path.isfile(content_dir + name):
+            # 輸入未改變的頁面沿用先前的輸出與搜尋內容
+            results[i] = (old["search"], {}, old["output"], False)
+            build["unchanged"].append(name)
+        else:
+            jobs_list.append((i, manifest["files"].get(name), content_dir))
+        new_manifest["pages"][name] = {"input": inputs}
+    timing["parse"] += time.perf_counter() - start
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs > 1 and len(jobs_list) > 1:
+        # 子程序由 initializer 取得本程序的 config 目錄與 snapshot, 不再自行讀取內容, imap 依頁面次序傳回結果
+        # 以 spawn 建立子程序, 不會在多執行緒的伺服器中 fork 而複製其他執行緒持有的 lock
+        import multiprocessing
+        with multiprocessing.get_context("spawn").Pool(jobs, _static_pool_init, (config_dir, content_store, snapshot)) as pool:
+            rendered = list(pool.imap(_static_page_job, jobs_list, chunksize=max(1, len(jobs_list) // (jobs * 4))))
+    else:
+        rendered = [_static_page(snapshot, i, old_output, content_dir) for i, old_output, content_dir in jobs_list]
+    for k in range(len(jobs_list)):
+        i = jobs_list[k][0]
+        results[i] = rendered[k]
+        if rendered[k][3]:
+            build["written"].append(newhead[i] + ".html")
+        else:
+            build["unchanged"].append(newhead[i] + ".html")
+    # 搜尋內容逐頁寫入 tipuesearch/ 的分片索引, 靜態頁面只載入小型的 tipuesearch_index.js
+    start = time.perf_counter()
+    # 字詞切割的 regex 編譯需時, 只在轉靜態網頁時才 import
+    import searchindex
+    search_index = searchindex.IndexWriter(content_dir)
+    timing["search"] += time.perf_counter() - start
+    for i in range(len(newhead)):
+        search_entry, page_timing, output, written = results[i]
+        start = time.perf_counter()
+        search_index.add(search_entry)
+        timing["search"] += time.perf_counter() - start
+        for phase in page_timing:
+            timing[phase] += page_timing[phase]
+        name = newhead[i] + ".html"
+        new_manifest["pages"][name]["output"] = output
+        new_manifest["pages"][name]["search"] = search_entry
+        new_manifest["files"][name] = output
+    # GENERATE js file
+    start = time.perf_counter()
+    search_index.close()
+    build["written"].extend(search_index.written)
+    build["unchanged"].extend(search_index.unchanged)
+    build["deleted"].extend(search_index.deleted)
+    # 舊版包含全部頁面內容的搜尋檔案
+    if os.path.isfile(content_dir + "tipuesearch_content.js"):
+        os.remove(content_dir + "tipuesearch_content.js")
+        build["deleted"].append("tipuesearch_content.js")
+    timing["search"] += time.perf_counter() - start
+    start = time.perf_counter()
+    contentstore.write_file(manifest_file[:-5] + "_staging.json", json.dumps(new_manifest, ensure_ascii=False))
+    if build["written"] or build["deleted"] or not os.path.isdir(output_dir):
+        # 全部檔案完成後才交換目錄, 靜態網站不會出現只有部分頁面的情形
+        _swap_static_dirs(output_dir, manifest_file)
+    else:
+        # 輸出沒有改變時保留原本的 _previous 目錄, rollback 仍回到上一次實際改變的版本
+        shutil.rmtree(output_dir + "_staging")
+        os.replace(manifest_file[:-5] + "_staging.json", manifest_file)
+    timing["write"] += time.perf_counter() - start
+    # 平行轉檔時各階段為所有程序的累計秒數, total 則為實際經過時間
+    timing["total"] = time.perf_counter() - build_start
+    return build
+
+
+def build_manifest_file(output_dir):
+
+    """Return build manifest file of output_dir, config/build_manifest.json for the content directory
+    """
+
+    if os.path.abspath(output_dir) == os.path.abspath(_curdir + "/content"):
+        return config_dir + "build_manifest.json"
+    # 其他輸出目錄各自記錄先前的轉檔結果
+    return config_dir + "build_manifest_" + contentstore.text_hash(os.path.abspath(output_dir))[:8] + ".json"
+
+
+def read_build_manifest(manifest_file=None):
+
+    """Return build manifest of the previous generate_static, config/build_manifest.json by default
+    """
+
+    if manifest_file is None:
+        manifest_file = config_dir + "build_manifest.json"
+    try:
+        with open(manifest_file, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"code": None, "pages": {}, "files": {}}
+
+
+def _write_static_file(content_dir, name, data, manifest, new_manifest, build, timing):
+
+    """Write data into content_dir/name only when it differs from the previous build
+    """
+
+    start = time.perf_counter()
+    output = contentstore.text_hash(data)
+    new_manifest["files"][name] = output
+    if manifest["files"].get(name) == output and os.path.isfile(content_dir + name):
+        build["unchanged"].append(name)
+    else:
+        # content_staging 中的檔案可能是 content 檔案的 hard link, 以 os.replace 寫入才不會改到 content
+        contentstore.write_file(content_dir + name, data)
+        build["written"].append(name)
+    timing["write"] += time.perf_counter() - start
+
+
+def _visible_text(element):
+
+    """Filter of page text shown in the browser for tipue search
+    """
+
+    if element.parent.name in ['style', 'script', '[document]', 'head', 'title']:
+        return False
+    elif re.match('<!--.*-->', str(element.encode('utf-8'))):
+        return False
+    return True
+
+
+def _static_page(snapshot, i, old_output=None, content_dir=None):
+
+    """Write static html file of page i when its output changed
+
+    傳回 tipue search 內容, 各階段秒數, 輸出的 hash 與是否寫入檔案
+    """
+
+    timing = {"render": 0.0, "search": 0.0, "write": 0.0}
+    newhead = snapshot.unique_head
+    # 在此必須要將頁面中的 /images/ 字串換為 images/, /downloads/ 換為 downloads/
+    # 因為 Flask 中靠 /images/ 取檔案, 但是一般 html 則採相對目錄取檔案
+    # 此一字串置換在 get_page2 中進行
+    # 加入 tipue search 模式
+    start = time.perf_counter()
+    get_page_content = []
+    html_doc = get_page2(newhead[i], newhead, 0, get_page_content, snapshot)
+    html_doc = html_doc.replace('<meta charset="utf-8">', '<meta charset="utf-8">\n<meta property="head" content="H'+str(snapshot.level[i])+'">')
+    timing["render"] += time.perf_counter() - start
+    start = time.perf_counter()
+    soup = beautiful_soup(" ".join(get_page_content), "lxml")
+    search_entry = {"title": newhead[i], "text": " ".join(filter(_visible_text, soup.findAll(text=True))), "tags": "", "url": newhead[i] + ".html"}
+    timing["search"] += time.perf_counter() - start
+    start = time.perf_counter()
+    output = contentstore.text_hash(html_doc)
+    if content_dir is None:
+        content_dir = _curdir + "/content/"
+    filename = content_dir + newhead[i] + ".html"
+    written = output != old_output or not os.path.isfile(filename)
+    if written:
+        # 增加以 newhead 作為輸入
+        contentstore.write_file(filename, html_doc)
+    timing["write"] += time.perf_counter() - start
+    return search_entry, timing, output, written
+
+
+_static_pool = {"snapshot": None}
+
+
+def _static_pool_init(pool_config_dir, pool_content_store, snapshot):
+
+    """Process pool initializer, use the config directory and content snapshot of the building process
+    """
+
+    global config_dir, content_store, content_version
+    config_dir = pool_config_dir
+    content_store = pool_content_store
+    _page_store["store"] = None
+    # 放入快取後, 各頁面共用 snapshot 中的選單
+    content_version = snapshot.version
+    _content_cache["entry"] = ((snapshot.version,) + snapshot.source_key, snapshot)
+    _static_pool["snapshot"] = snapshot
+
+
+def _static_page_job(job):
+
+    """Process pool entry of _static_page, job is (page order, previous output hash, output directory)
+    """
+
+    return _static_page(_static_pool["snapshot"], job[0], job[1], job[2])
+
+
+def _prepare_staging(output_dir):
+
+    """Return output_dir + _staging directory holding links to the current output files
+    """
+
+    staging = output_dir + "_staging"
+    # 上次轉檔中斷留下的目錄
+    if os.path.isdir(staging):
+        shutil.rmtree(staging)
+    os.makedirs(staging)
+    if os.path.isdir(output_dir):
+        for name in os.listdir(output_dir):
+            source = os.path.join(output_dir, name)
+            if os.path.isdir(source):
+                try:
+                    shutil.copytree(source, os.path.join(staging, name), copy_function=os.link)
+                except (OSError, shutil.Error):
+                    shutil.rmtree(os.path.join(staging, name), ignore_errors=True)
+                    shutil.copytree(source, os.path.join(staging, name))
+                continue
+            try:
+                # 以 hard link 取代複製, 未改變的檔案不必再寫入
+                os.link(source, os.path.join(staging, name))
+            except OSError:
+                shutil.copy2(source, os.path.join(staging, name))
+    return staging
+
+
+def _swap_directories(current, other):
+
+    """Exchange current and other, each of them may be a directory or a file
+    """
+
+    temp = current + "_swap"
+    if os.path.exists(other):
+        os.rename(other, temp)
+    if os.path.exists(current):
+        os.rename(current, other)
+    if os.path.exists(temp):
+        os.rename(temp, current)
+
+
+def _swap_static_dirs(output_dir, manifest_file):
+
+    """Replace output_dir with its staging directory and keep the replaced build as output_dir + _previous
+    """
+
+    previous = output_dir + "_previous"
+    if os.path.isdir(previous):
+        shutil.rmtree(previous)
+    if os.path.isdir(output_dir):
+        os.rename(output_dir, previous)
+    os.rename(output_dir + "_staging", output_dir)
+    # build manifest 對應輸出目錄, 與 _previous 目錄一起保留上一版
+    if os.path.isfile(manifest_file):
+        os.replace(manifest_file, manifest_file[:-5] + "_previous.json")
+    os.replace(manifest_file[:-5] + "_staging.json", manifest_file)
+
+
+def rollback_static(output_dir=None):
+
+    """Exchange content with content_previous, return False if there is no previous build
+    """
+
+    if output_dir is None:
+        output_dir = _curdir + "/content"
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.isdir(output_dir + "_previous"):
+        return False
+    # 交換後再執行一次即可回到原本的版本
+    manifest_file = build_manifest_file(output_dir)
+    _swap_directories(output_dir, output_dir + "_previous")
+    _swap_directories(manifest_file, manifest_file[:-5] + "_previous.json")
+    return True
+
+
+def build_report(build):
+
+    """Return html listing changed files and seconds spent in each phase of generate_static
+    """
+
+    report = "寫入 " + str(len(build["written"])) + " 個檔案, 未改變 " + str(len(build["unchanged"])) + \
+                " 個, 刪除 " + str(len(build["deleted"])) + " 個"
+    for name in build["written"]:
+        report += "<br />寫入: " + name
+    for name in build["deleted"]:
+        report += "<br />刪除: " + name
+    report += "<br /><br />各階段耗時 (秒):"
+    timing = build["timing"]
+    for phase in timing:
+        report += "<br />" + phase + ": " + "%.3f" % timing[phase]
+    return report
+
+
 # seperate page need heading and edit variables, if edit=1, system will enter edit mode
 # single page edit will use ssavePage to save content, it means seperate save page
 @app.route('/get_page')
@@ -1009,47 +1338,73 @@ def get_page(heading, edit):
     """Get dynamic page content
     """
 
-    head, level, page = parse_content()
-    directory = render_menu(head, level, page)
+    snapshot = content_snapshot()
     if heading is None:
-        heading = head[0]
+        heading = snapshot.head[0]
+    # 瀏覽模式的頁面在內容未改變前可由瀏覽器快取, 回應 304 時不必產生頁面
+    if edit == 0:
+        return conditional_response(snapshot, ("get_page", tuple(snapshot.index.get(heading, []))),
+                                    lambda: _get_page(snapshot, heading, edit))
+    return _get_page(snapshot, heading, edit)
+
+
+def _get_page(snapshot, heading, edit):
+
+    """Render dynamic page of heading
+    """
+
+    head, level, page = snapshot.head, snapshot.level, snapshot.page
+    directory = render_menu(head, level, page)
     # 因為同一 heading 可能有多頁, 因此不可使用 head.index(heading) 搜尋 page_order
-    page_order_list, page_content_list = search_content(head, page, heading)
+    page_order_list, page_content_list = search_content(head, page, heading, snapshot.index)
     return_content = ""
     pagedata = ""
     outstring = ""
     outstring_duplicate = ""
     pagedata_duplicate = ""
     outstring_list = []
-    for i in range(len(page_order_list)):
-        #page_order = head.index(heading)
-        page_order = page_order_list[i]
-        if page_order == 0:
-            last_page = ""
-        else:
-            last_page = head[page_order-1] + " << <a href='/get_page/" + \
-                             head[page_order-1] + "'>Previous</a>"
-        if page_order == len(head) - 1:
-            # no next page
-            next_page = ""
-        else:
-            next_page = "<a href='/get_page/"+ head[page_order+1] + \
-                              "'>Next</a> >> " + head[page_order+1]
-        if len(page_order_list) > 1:
-            return_content += last_page + " " + next_page + \
-                                      "<br /><h1>" + heading + "</h1>" + \
-                                      page_content_list[i] + "<br />"+ \
-                                      last_page + " " + next_page + "<br /><hr>"
-            pagedata_duplicate = "<h"+level[page_order] + ">" + heading + \
-                                          "</h"+level[page_order] + ">" + page_content_list[i]
-            outstring_list.append(last_page + " " + next_page + "<br />" + tinymce_editor(directory, html_escape(pagedata_duplicate), page_order))
-        else:
-            return_content += last_page + " " + next_page + "<br /><h1>" +\
-                                      heading + "</h1>" + page_content_list[i] + "<br />" + last_page + " " + next_page
+    # 瀏覽模式的頁面內容存於 page_cache, 內容版本改變後不再使用
+    key = (snapshot.source_key, snapshot.version, "get_page", heading)
+    cached = None
+    if edit == 0:
+        cached = page_cache.get(key)
+    if cached is not None:
+        return_content = cached
+    else:
+        for i in range(len(page_order_list)):
+            #page_order = head.index(heading)
+            page_order = page_order_list[i]
+            previous_head, next_head = snapshot.neighbours[page_order]
+            if previous_head is None:
+                last_page = ""
+            else:
+                last_page = previous_head + " << <a href='/get_page/" + \
+                                 previous_head + "'>Previous</a>"
+            if next_head is None:
+                # no next page
+                next_page = ""
+            else:
+                next_page = "<a href='/get_page/"+ next_head + \
+                                  "'>Next</a> >> " + next_head
+            if len(page_order_list) > 1:
+                return_content += last_page + " " + next_page + \
+                                          "<br /><h1>" + heading + "</h1>" + \
+                                          page_content_list[i] + "<br />"+ \
+                                          last_page + " " + next_page + "<br /><hr>"
+                pagedata_duplicate = "<h"+level[page_order] + ">" + heading + \
+                                              "</h"+level[page_order] + ">" + page_content_list[i]
+                if edit != 0:
+                    outstring_list.append(last_page + " " + next_page + "<br />" + tinymce_editor(directory, html_escape(pagedata_duplicate), page_order))
+            else:
+                return_content += last_page + " " + next_page + "<br /><h1>" +\
+                                          heading + "</h1>" + page_content_list[i] + "<br />" + last_page + " " + next_page
             
-        pagedata += "<h"+level[page_order] + ">" + heading + "</h" + level[page_order] + ">" + page_content_list[i]
-        # 利用 html_escape() 將 specialchar 轉成只能顯示的格式
-        outstring += last_page + " " + next_page + "<br />" + tinymce_editor(directory, html_escape(pagedata), page_order)
+            pagedata += "<h"+level[page_order] + ">" + heading + "</h" + level[page_order] + ">" + page_content_list[i]
+            # 利用 html_escape() 將 specialchar 轉成只能顯示的格式
+            if edit != 0:
+                outstring += last_page + " " + next_page + "<br />" + tinymce_editor(directory, html_escape(pagedata), page_order)
+        if edit == 0:
+            page_cache.put(key, return_content)
     
     # edit=0 for viewpage
     if edit == 0:
@@ -1071,70 +1426,80 @@ def get_page(heading, edit):
                 return outstring
 
 
-def get_page2(heading, head, edit, get_page_content = None):
+def get_page2(heading, head, edit, get_page_content = None, snapshot = None):
 
     """Get page content and replace certain string for static site
     """
 
-    not_used_head, level, page = parse_content()
-    # 直接在此將 /images/ 換為 ./../images/, /downloads/ 換為 ./../downloads/, 以 content 為基準的相對目錄設定
-
-    page = [w.replace('src="/images/', 'src="./../images/') for w in page]
-    page = [w.replace('href="/downloads/', 'href="./../downloads/') for w in page]
-    # 配合 object 標註導入 svg data 來源的轉換
-    page = [w.replace('data="/images/', 'data="./../images/') for w in page]
-    # 假如有 src="/static/ace/ 則換為 src="./../static/ace/
-    page = [w.replace('src="/static/', 'src="./../cmsimde/static/') for w in page]
-    # 假如有 src=/downloads 則換為 src=./../../downloads
-    page = [w.replace('src="/downloads', 'src="./../downloads') for w in page]
-    # 假如有 pythonpath:['/static/' 則換為 ./../cmsimde/static/
-    page = [w.replace("pythonpath:['/static/'", "pythonpath:['./../cmsimde/static/'") for w in page]
-    # 針對 wink3 假如有 data-dirname="/static" 換為 data-dirname="./../cmsimde/static"
-    page = [w.replace("data-dirname=\"/static\"", "data-dirname=\"./../cmsimde/static\"") for w in page]
-    # 假如有 /get_page 則需額外使用 regex 進行字串代換, 表示要在靜態網頁直接取網頁 (尚未完成)
-    #page = [w.replace('/get_page', '') for w in page]
-
-    directory = render_menu2(head, level, page)
+    # generate_static 傳入共用的 snapshot
+    if snapshot is None:
+        snapshot = content_snapshot()
+    level, page = snapshot.level, snapshot.page
+    # generate_pages 傳入的 head 為 snapshot.unique_head, 可直接使用其索引
+    if head is snapshot.unique_head:
+        index, neighbours = snapshot.unique_index, snapshot.unique_neighbours
+    else:
+        index, neighbours = heading_index(head), heading_neighbours(head)
     if heading is None:
         heading = head[0]
-    # 因為同一 heading 可能有多頁, 因此不可使用 head.index(heading) 搜尋 page_order
-    page_order_list, page_content_list = search_content(head, page, heading)
-    if get_page_content != None:
-        get_page_content.extend(page_content_list)
+    # external 時選單由 generate_static 寫出的共用 menu-*.js 載入, 頁面只保留麵包屑
+    if getattr(init.Init, "static_menu", "inline") == "external":
+        directory = render_menu2_external(head, level, page, index.get(heading, [None])[0])
+    else:
+        directory = render_menu2(head, level, page)
     return_content = ""
     pagedata = ""
     outstring = ""
     outstring_duplicate = ""
     pagedata_duplicate = ""
     outstring_list = []
-    for i in range(len(page_order_list)):
-        page_order = page_order_list[i]
-        if page_order == 0:
-            last_page = ""
-        else:
-            #last_page = head[page_order-1]+ " << <a href='/get_page/" + head[page_order-1] + "'>Previous</a>"
-            last_page = head[page_order-1] + " << <a href='"+head[page_order-1] + ".html'>Previous</a>"
-        if page_order == len(head) - 1:
-            # no next page
-            next_page = ""
-        else:
-            #next_page = "<a href='/get_page/"+head[page_order+1] + "'>Next</a> >> " + head[page_order+1]
-            next_page = "<a href='" + head[page_order+1] + ".html'>Next</a> >> " + head[page_order+1]
-        if len(page_order_list) > 1:
-            return_content += last_page + " " + next_page + "<br /><h1>" + \
-                                      heading + "</h1>" + page_content_list[i] + \
-                                      "<br />" + last_page + " "+ next_page + "<br /><hr>"
-            pagedata_duplicate = "<h"+level[page_order] + ">" + heading + "</h" + level[page_order]+">"+page_content_list[i]
-            outstring_list.append(last_page + " " + next_page + "<br />" + tinymce_editor(directory, html_escape(pagedata_duplicate), page_order))
-        else:
-            return_content += last_page + " " + next_page + "<br /><h1>" + \
-                                      heading + "</h1>" + page_content_list[i] + \
-                                      "<br />" + last_page + " " + next_page
-
-        pagedata += "<h" + level[page_order] + ">" + heading + \
-                          "</h" + level[page_order] + ">" + page_content_list[i]
-        # 利用 html_escape() 將 specialchar 轉成只能顯示的格式
-        outstring += last_page + " " + next_page + "<br />" + tinymce_editor(directory, html_escape(pagedata), page_order)
+    # 靜態頁面內容存於 page_cache, 只有 head 取自 snapshot 時才能以標題作為 key
+    key = (snapshot.source_key, snapshot.version, "get_page2", head is snapshot.unique_head, heading)
+    cached = None
+    if edit == 0 and (head is snapshot.head or head is snapshot.unique_head):
+        cached = page_cache.get(key)
+    if cached is not None:
+        return_content, page_content_list = cached
+    else:
+        # 因為同一 heading 可能有多頁, 因此不可使用 head.index(heading) 搜尋 page_order
+        page_order_list, page_content_list = search_content(head, page, heading, index)
+        # 只轉換此標題的頁面, 不再逐一轉換全部頁面
+        page_content_list = [static_page_content(w, snapshot.index) for w in page_content_list]
+        for i in range(len(page_order_list)):
+            page_order = page_order_list[i]
+            previous_head, next_head = neighbours[page_order]
+            if previous_head is None:
+                last_page = ""
+            else:
+                #last_page = head[page_order-1]+ " << <a href='/get_page/" + head[page_order-1] + "'>Previous</a>"
+                last_page = previous_head + " << <a href='" + previous_head + ".html'>Previous</a>"
+            if next_head is None:
+                # no next page
+                next_page = ""
+            else:
+                #next_page = "<a href='/get_page/"+head[page_order+1] + "'>Next</a> >> " + head[page_order+1]
+                next_page = "<a href='" + next_head + ".html'>Next</a> >> " + next_head
+            if len(page_order_list) > 1:
+                return_content += last_page + " " + next_page + "<br /><h1>" + \
+                                          heading + "</h1>" + page_content_list[i] + \
+                                          "<br />" + last_page + " "+ next_page + "<br /><hr>"
+                pagedata_duplicate = "<h"+level[page_order] + ">" + heading + "</h" + level[page_order]+">"+page_content_list[i]
+                if edit != 0:
+                    outstring_list.append(last_page + " " + next_page + "<br />" + tinymce_editor(directory, html_escape(pagedata_duplicate), page_order))
+            else:
+                return_content += last_page + " " + next_page + "<br /><h1>" + \
+                                          heading + "</h1>" + page_content_list[i] + \
+                                          "<br />" + last_page + " " + next_page
+
+            pagedata += "<h" + level[page_order] + ">" + heading + \
+                              "</h" + level[page_order] + ">" + page_content_list[i]
+            # 利用 html_escape() 將 specialchar 轉成只能顯示的格式
+            if edit != 0:
+                outstring += last_page + " " + next_page + "<br />" + tinymce_editor(directory, html_escape(pagedata), page_order)
+        if edit == 0 and (head is snapshot.head or head is snapshot.unique_head):
+            page_cache.put(key, (return_content, page_content_list))
+    if get_page_content != None:
+        get_page_content.extend(page_content_list)
     
     # edit=0 for viewpage
     if edit == 0:
@@ -1200,6 +1565,47 @@ def get_page2(heading, head, edit, get_page_content = None):
                 return outstring
 
 
+# 靜態網頁的絕對路徑以 content 為基準改為相對目錄, 所有規則合併為單一 regex 一次代換
+static_rewrites = {
+    # 直接在此將 /images/ 換為 ./../images/, /downloads/ 換為 ./../downloads/
+    'src="/images/': 'src="./../images/',
+    'href="/downloads/': 'href="./../downloads/',
+    # 配合 object 標註導入 svg data 來源的轉換
+    'data="/images/': 'data="./../images/',
+    # 假如有 src="/static/ace/ 則換為 src="./../static/ace/
+    'src="/static/': 'src="./../cmsimde/static/',
+    # 假如有 src=/downloads 則換為 src=./../../downloads
+    'src="/downloads': 'src="./../downloads',
+    # 假如有 pythonpath:['/static/' 則換為 ./../cmsimde/static/
+    "pythonpath:['/static/'": "pythonpath:['./../cmsimde/static/'",
+    # 針對 wink3 假如有 data-dirname="/static" 換為 data-dirname="./../cmsimde/static"
+    'data-dirname="/static"': 'data-dirname="./../cmsimde/static"',
+}
+# href="/get_page/標題" 或 href="/get_page/標題#anchor" 換為靜態網頁的 標題.html
+static_rewrite_pattern = re.compile("|".join(re.escape(k) for k in sorted(static_rewrites, key=len, reverse=True)) +
+                                    "|href=([\"'])/get_page/([^\"'#?/]+)(#[^\"']*)?\\1")
+
+
+def _static_rewrite(match, index=None):
+    if match.group(1) is None:
+        return static_rewrites[match.group(0)]
+    name = match.group(2)
+    # 重複標題的靜態網頁為 標題-1.html, 標題-2.html..., 連結指向第一頁
+    if index is not None and len(index.get(urllib.parse.unquote(name), [])) > 1:
+        name += "-1"
+    return "href=" + match.group(1) + name + ".html" + (match.group(3) or "") + match.group(1)
+
+
+def static_page_content(page, index=None):
+
+    """Replace absolute paths in page content with paths relative to the content directory
+
+    index 為 snapshot.index, 用來將重複標題的連結改為對應的靜態網頁檔名
+    """
+
+    return static_rewrite_pattern.sub(lambda match: _static_rewrite(match, index), page)
+
+
 def get_wan_address():
 
     """get wide area network address
@@ -1635,6 +2041,109 @@ def isAdmin():
         return False
 
 
+@app.route('/metrics')
+def metrics_page():
+
+    """Return request and cache metrics in Prometheus text format
+    """
+
+    # Prometheus 無法登入, 可在 init.py 設定 metrics_token 後以 Authorization: Bearer 標頭取得
+    metrics_token = getattr(init.Init, "metrics_token", "")
+    authorization = request.headers.get("Authorization", "")
+    # 以 compare_digest 比對, 比對時間不因 token 相符的長度而不同; 標頭可能含非 ASCII 字元, 先轉為 bytes
+    if not isAdmin() and not (metrics_token and hmac.compare_digest(authorization.encode("utf-8"),
+                                                                    ("Bearer " + metrics_token).encode("utf-8"))):
+        return redirect("/login")
+    stats = page_cache.stats()
+    metrics.registry.set("cmsimde_cache_hits_total", stats["hits"], cache="page")
+    metrics.registry.set("cmsimde_cache_misses_total", stats["misses"], cache="page")
+    metrics.registry.ratio("cmsimde_cache_hit_ratio", "cmsimde_cache_hits_total", "cmsimde_cache_misses_total")
+    response = make_response(metrics.registry.render())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
+@app.before_request
+def profile_request():
+
+    """Start profiling the request if the admin asked for it with ?profile= or /profiles
+    """
+
+    route = request.url_rule.rule if request.url_rule is not None else None
+    # 檢視剖析結果與靜態檔案的 request 不列入
+    if route is None or route.startswith(("/profiles", "/static", "/metrics")):
+        return
+    kind = request.args.get("profile")
+    if kind and isAdmin():
+        kind = kind if kind in profiler.KINDS else "cprofile"
+    else:
+        kind = request_profiler.take(route)
+    if kind:
+        request.environ["cmsimde.profile"] = (request_profiler.start(kind), time.perf_counter())
+
+
+@app.teardown_request
+def save_profile(exception=None):
+    session_start = request.environ.pop("cmsimde.profile", None)
+    if session_start is not None:
+        request_profiler.save(session_start[0], request.method, request.url_rule.rule,
+                              time.perf_counter() - session_start[1])
+
+
+@app.route('/profiles', methods=['GET', 'POST'])
+def profiles():
+
+    """Arm profiling of the next requests and list saved profiles
+    """
+
+    if not isAdmin():
+        return redirect("/login")
+    if request.method == "POST":
+        count = request.form.get("count", "1")
+        request_profiler.arm(int(count) if count.isdigit() else 1, request.form.get("route", "").strip(),
+                             request.form.get("kind", "cprofile"))
+        return redirect("/profiles")
+    head, level, page = parse_content()
+    directory = render_menu(head, level, page)
+    routes = sorted(set(rule.rule for rule in app.url_map.iter_rules()))
+    outstring = "<h1>Profiles</h1>"
+    if request_profiler.remaining > 0:
+        outstring += "<p>profiling the next " + str(request_profiler.remaining) + " requests of " + \
+                     html_escape(request_profiler.route or "any route") + " with " + request_profiler.kind + "</p>"
+    outstring += """<form method='post' action='/profiles'>
+    requests: <input type='text' name='count' value='1' size='4'>
+    route: <input type='text' name='route' list='routes' placeholder='any route'>
+    <datalist id='routes'>""" + "".join("<option value='" + html_escape(rule) + "'>" for rule in routes) + """</datalist>
+    <select name='kind'><option value='cprofile'>cProfile</option><option value='sample'>stack sampler</option></select>
+    <input type='submit' value='profile'></form>
+    <p>admin 也可在網址加上 ?profile=cprofile 或 ?profile=sample 剖析單一 request</p><ul>"""
+    for name in request_profiler.profiles():
+        outstring += "<li><a href='/profiles/" + name + "'>" + name + "</a></li>"
+    outstring += "</ul>"
+    return set_css() + "<div class='container'><nav>" + \
+             directory + "</nav><section>" + outstring + "</section></div></body></html>"
+
+
+@app.route('/profiles/<name>')
+def profile_detail(name):
+
+    """Show the top cumulative functions of a saved profile
+    """
+
+    if not isAdmin():
+        return redirect("/login")
+    if name not in request_profiler.profiles():
+        return redirect("/profiles")
+    if request.args.get("download"):
+        return send_from_directory(request_profiler.directory, name, as_attachment=True)
+    head, level, page = parse_content()
+    directory = render_menu(head, level, page)
+    return set_css() + "<div class='container'><nav>" + \
+             directory + "</nav><section><h1>" + name + "</h1>" + \
+             "<p><a href='/profiles/" + name + "?download=1'>download</a> <a href='/profiles'>profiles</a></p>" + \
+             "<pre>" + html_escape(request_profiler.top(name)) + "</pre></section></div></body></html>"
+
+
 # use to check directory variable data
 @app.route('/listdir')
 def listdir():
@@ -1978,6 +2487,59 @@ def parse_config():
     return site_title, password
 
 
+def normalize_content(subject):
+
+    """Return content.htm source with h1-h3 headings normalized
+    """
+
+    return _normalize_soup(subject)[0]
+
+
+def normalize_content_file():
+
+    """One-off migration to write normalized headings back into content.htm
+    """
+
+    subject = file_get_contents(config_dir + "content.htm")
+    normalized = normalize_content(subject)
+    if normalized == subject:
+        return False
+    shutil.copy2(config_dir + "content.htm", config_dir + "content_backup.htm")
+    save_content(normalized)
+    return True
+
+
+def beautiful_soup(markup, features):
+
+    """Return bs4.BeautifulSoup(markup, features), bs4 is imported at first use
+
+    bs4 在存檔, 正規化與轉靜態網頁時才需要, 不在啟動時 import, 縮短各程序的啟動時間
+    """
+
+    import bs4
+    # 針對單一頁面有許多 html 標註時, 增大遞迴圈數設定
+    sys.setrecursionlimit(1000000)
+    return bs4.BeautifulSoup(markup, features)
+
+
+def _normalize_soup(subject):
+
+    """Apply _remove_h123_attrs until the html source no longer changes
+
+    傳回正規化後的 subject 與對應的 soup, 標題標註字串可直接用來切割 subject
+    """
+
+    # 移除標題或插入 br 後, 相鄰字串需要再解析一次才會穩定
+    for i in range(3):
+        soup = _remove_h123_attrs(beautiful_soup(subject, 'html.parser'))
+        # 與讀取檔案時相同, 統一換行字元
+        normalized = str(soup).replace("\r\n", "\n").replace("\r", "\n")
+        if normalized == subject:
+            break
+        subject = normalized
+    return subject, soup
+
+
 def _remove_h123_attrs(soup):
 
     """Remove h1-h3 tag attribute
@@ -2032,11 +2594,326 @@ def _remove_h123_attrs(soup):
     return soup
 
 
+# content.htm 解析結果快取, 在檔案 mtime/size/inode 或 content_version 改變之前, 各 request 共用同一份 snapshot
+content_version = 0
+# entry 為 (key, snapshot), 以單一 tuple 替換, 不加 lock 讀取時 key 與 snapshot 必定對應
+_content_cache = {"entry": None}
+_content_lock = threading.RLock()
+
+
+class ContentSnapshot(object):
+
+    """Parsed head, level and page lists of one content.htm version
+    """
+
+    def __init__(self, head, level, page, key, tag=None):
+        self.head = head
+        self.level = level
+        self.page = page
+        # 各頁面原始的標題標註, 以 bs4 正規化切割時為 None
+        self.tag = tag
+        # key 為 _content_key() 傳回值, 依序為 content_version 與 content.htm 或頁面儲存的修改時間 (ns)
+        self.version = key[0]
+        self.mtime = key[1] / 1e9
+        # 不含 content_version 的 key 在各 process 間相同, 可用於 ETag
+        self.source_key = key[1:]
+        # 標題對應頁面次序的索引, 同一標題可能有多頁
+        self.index = heading_index(head)
+        # 各頁面次序的前一頁與下一頁標題
+        self.neighbours = heading_neighbours(head)
+        # 靜態網頁檔名, 重複標題依序加上 -1, -2...
+        self.unique_head = unique_heading(head, self.index)
+        self.unique_index = heading_index(self.unique_head)
+        self.unique_neighbours = heading_neighbours(self.unique_head)
+        # 選單樹狀結構與各 render_menu 產生的 html, 同一版本的內容只產生一次
+        self.menu_tree = menu_tree(level)
+        self.menus = {}
+
+
+def heading_index(head):
+
+    """Return dict of heading to list of page orders
+    """
+
+    index = {}
+    for i, v in enumerate(head):
+        index.setdefault(v, []).append(i)
+    return index
+
+
+def heading_neighbours(head):
+
+    """Return list of (previous heading, next heading) for each page order
+    """
+
+    previous = [None] + head[:-1]
+    following = head[1:] + [None]
+    return list(zip(previous, following))
+
+
+def unique_heading(head, index):
+
+    """Return head list with duplicated headings numbered for file names
+    """
+
+    # 處理重複標題 head 數列， 重複標題則按照次序加上 1, 2, 3...
+    newhead = list(head)
+    for v, orders in index.items():
+        if len(orders) > 1:
+            for count, i in enumerate(orders):
+                newhead[i] = v + "-" + str(count + 1)
+    return newhead
+
+
+def bump_content_version():
+
+    """Invalidate the cached content snapshot after content.htm is written
+    """
+
+    global content_version
+    with _content_lock:
+        content_version += 1
+        _content_cache["entry"] = None
+        page_cache.clear()
+    return content_version
+
+
+def _content_key():
+
+    """Return the cache key of content.htm or the page store, None if no content
+    """
+
+    store = page_store()
+    try:
+        if store is None:
+            stat = os.stat(config_dir + "content.htm")
+            return (content_version, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        return (content_version,) + store.key()
+    except OSError:
+        return None
+
+
+def conditional_response(snapshot, key, render):
+
+    """Return 304 when the client copy of this page is current, otherwise render() with ETag and Last-Modified
+
+    ETag 由 content.htm 或頁面儲存的版本, key (頁面次序等) 與是否為管理者組成,
+    Last-Modified 無法區分登入前後的頁面, 只用於沒有 session 的 request
+    """
+
+    if isinstance(snapshot, str):
+        return render()
+    # sitetitle 會出現在各頁面標頭, 修改後也必須重新產生頁面
+    try:
+        title_mtime = os.stat(config_dir + "sitetitle").st_mtime
+    except OSError:
+        title_mtime = 0
+    admin = isAdmin()
+    etag = hashlib.sha1(repr((snapshot.source_key, title_mtime, admin) + key).encode("utf-8")).hexdigest()
+    last_modified = None
+    if not admin and not session:
+        last_modified = int(max(snapshot.mtime, title_mtime))
+    # If-None-Match 優先於 If-Modified-Since
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    elif request.if_modified_since and last_modified is not None:
+        not_modified = last_modified <= request.if_modified_since.timestamp()
+    else:
+        not_modified = False
+    if not_modified:
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # 登入前後的頁面不同, 快取須依 Cookie 區分
+    response.vary.add("Cookie")
+    # 每次使用前仍須向伺服器確認, 管理者頁面不可由共用的 proxy 快取
+    if admin:
+        response.headers["Cache-Control"] = "private, no-cache"
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def content_pages(subject):
+
+    """Return (heading, level, tag, page) tuples of normalized subject
+    """
+
+    result = split_pages(subject)
+    if result is not None:
+        return result[1]
+    head, level, page = _split_content_bs4(subject)
+    return [(head[i], level[i], "<h" + level[i] + ">" + head[i] + "</h" + level[i] + ">", page[i])
+                for i in range(len(head))]
+
+
+def content_source():
+
+    """Return all pages in content.htm format
+    """
+
+    store = page_store()
+    if store is None:
+        return file_get_contents(config_dir + "content.htm")
+    return store.export()
+
+
+def _stored_source():
+
+    """Return content currently saved, empty string before the first save
+    """
+
+    store = page_store()
+    if store is None:
+        if not os.path.isfile(config_dir + "content.htm"):
+            return ""
+        return file_get_contents(config_dir + "content.htm")
+    if not store.exists():
+        return ""
+    return store.export()
+
+
+def _write_source(subject):
+
+    """Write normalized subject into content.htm or the page store
+    """
+
+    store = page_store()
+    if store is None:
+        contentstore.write_file(config_dir + "content.htm", subject)
+    else:
+        store.save_all(content_pages(subject))
+    bump_content_version()
+
+
+def undo_content():
+
+    """Revert the newest change recorded in the journal, return the reverted entry
+
+    目前內容與 journal 記錄不符 (例如 content.htm 已在外部修改) 時不回復, 傳回 None
+    """
+
+    with _content_lock:
+        entries = journal.read()
+        if len(entries) == 0:
+            return None
+        entry = entries[-1]
+        subject = _stored_source()
+        offset = entry["offset"]
+        current = subject[offset:offset+len(entry["new"])]
+        if contentstore.text_hash(current) != entry["new_hash"]:
+            return None
+        _write_source(subject[:offset] + entry["old"] + subject[offset+len(entry["new"]):])
+        journal.pop()
+    return entry
+
+
+def export_content():
+
+    """Write pages of the page store into config/content.htm
+    """
+
+    store = page_store()
+    if store is None or not store.exists():
+        return False
+    contentstore.write_file(config_dir + "content.htm", store.export())
+    return True
+
+
+def import_content():
+
+    """Import config/content.htm into the page store
+    """
+
+    store = page_store()
+    if store is None:
+        return False
+    subject = normalize_content(file_get_contents(config_dir + "content.htm"))
+    with _content_lock:
+        store.save_all(content_pages(subject))
+        bump_content_version()
+    return True
+
+
+_page_store = {"store": None}
+
+
+def page_store():
+
+    """Return the page store selected by Init.content_store, None for content.htm
+    """
+
+    if _page_store["store"] is None:
+        if content_store == "shard":
+            _page_store["store"] = contentstore.ShardStore(config_dir + "pages")
+        elif content_store == "sqlite":
+            # SQLiteStore 保留各執行緒的資料庫連線, 因此只建立一次
+            _page_store["store"] = contentstore.SQLiteStore(config_dir + "content.db")
+    return _page_store["store"]
+
+
+def content_snapshot():
+
+    """Return cached ContentSnapshot, parse content.htm again only when it changed
+    """
+
+    key = _content_key()
+    if key is None:
+        return "Error: no content.htm"
+    entry = _content_cache["entry"]
+    if entry is not None and entry[0] == key:
+        metrics.registry.inc("cmsimde_cache_hits_total", cache="content")
+        return entry[1]
+    metrics.registry.inc("cmsimde_cache_misses_total", cache="content")
+    with _content_lock:
+        # 其他執行緒可能已經完成解析
+        key = _content_key()
+        if key is None:
+            return "Error: no content.htm"
+        entry = _content_cache["entry"]
+        if entry is not None and entry[0] == key:
+            return entry[1]
+        start = time.perf_counter()
+        result = _parse_content_file()
+        metrics.registry.observe("cmsimde_content_parse_seconds", time.perf_counter() - start)
+        if isinstance(result, str):
+            return result
+        head, level, page, tag = result
+        # 採用解析前取得的 key, 若解析期間 content.htm 被改寫, 下一個 request 會重新解析
+        snapshot = ContentSnapshot(head, level, page, key, tag)
+        _content_cache["entry"] = (key, snapshot)
+        # content.htm 在外部修改時, 舊版本的頁面不會再使用
+        page_cache.clear()
+    return snapshot
+
+
 def parse_content():
 
+    """Return head, level and page lists of content.htm from the cached snapshot
+
+    各 request 應視傳回的數列為唯讀資料
+    """
+
+    snapshot = content_snapshot()
+    if isinstance(snapshot, str):
+        return snapshot
+    return snapshot.head, snapshot.level, snapshot.page
+
+
+def _parse_content_file():
+
     """Use bs4 and re module functions to parse content.htm
     """
 
+    store = page_store()
+    if store is not None:
+        head, level, page, tag = store.load()
+        if len(head) == 0:
+            return "Error: no data in content store"
+        return head, level, page, tag
     #from pybean import Store, SQLiteWriter
     # if no content.db, create database file with cms table
     '''
@@ -2068,18 +2945,26 @@ def parse_content():
             f.write("<h1>head 1</h1>content 1")
         subject = "<h1>head 1</h1>content 1"
         '''
+    # 已正規化的 content.htm 以單次 html.parser 掃描切割, 否則改用 bs4 正規化後切割
+    result = split_pages(subject)
+    if result is None or len(result[1]) == 0:
+        head, level, page = _split_content_bs4(subject)
+        return head, level, page, None
+    pages = result[1]
+    return [p[0] for p in pages], [p[1] for p in pages], [p[3] for p in pages], [p[2] for p in pages]
+
+
+def _split_content_bs4(subject):
+
+    """Normalize subject with bs4 then split it by h1, h2 and h3 tags
+    """
+
     # initialize the return lists
     head_list = []
     level_list = []
     page_list = []
-    # make the soup out of the html content
-    soup = bs4.BeautifulSoup(subject, 'html.parser')
-    # 嘗試解讀各種情況下的標題
-    soup = _remove_h123_attrs(soup)
-    # 改寫 content.htm 後重新取 subject
-    with open(config_dir + "content.htm", "wb") as f:
-        f.write(soup.encode("utf-8"))
-    subject = file_get_contents(config_dir+"content.htm")
+    # 標題正規化已於存檔時完成, 這裡只在記憶體中處理, 不再改寫 content.htm
+    subject, soup = _normalize_soup(subject)
     # get all h1, h2, h3 tags into list
     htag= soup.find_all(['h1', 'h2', 'h3'])
     n = len(htag)
@@ -2120,6 +3005,157 @@ def parse_content():
     return head_list, level_list, page_list
 
 
+class HeadingSplitter(html.parser.HTMLParser):
+
+    """Record h1, h2 and h3 offsets of content.htm in one html.parser pass
+    """
+
+    heading_tags = ("h1", "h2", "h3")
+    void_tags = ("area", "base", "br", "col", "embed", "hr", "img", "input",
+                       "link", "meta", "param", "source", "track", "wbr")
+
+    def __init__(self, subject, first=True):
+        super().__init__(convert_charrefs=True)
+        self.subject = subject
+        # 單頁存檔時 subject 並非 content.htm 開頭, 第一個標題不必為 h1
+        self.first = first
+        # 各行起點位置, 用來將 getpos() 換算為 subject 字元位置
+        self.line_start = [0] + [m.end() for m in re.finditer("\n", subject)]
+        # 各標題為 (name, start, end, text)
+        self.headings = []
+        # 若標題仍需 _remove_h123_attrs 處理, 則改由 bs4 切割
+        self.normalized = True
+        self.current = None
+
+    def source_offset(self):
+        lineno, col = self.getpos()
+        return self.line_start[lineno - 1] + col
+
+    def child(self, kind):
+        # 計算標題標註下的直接子元件數, 相鄰字串合併計算
+        if self.depth == 0 and not (kind == "text" and self.last_kind == "text"):
+            self.contents += 1
+            self.child_kind = kind
+        self.last_kind = kind
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.heading_tags:
+            if self.current is not None:
+                self.normalized = False
+                return
+            start = self.source_offset()
+            self.current = (tag, start)
+            self.depth = 0
+            self.contents = 0
+            self.child_kind = None
+            self.last_kind = None
+            self.text = []
+        elif self.current is not None:
+            self.child("tag")
+            if tag not in self.void_tags:
+                self.depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.heading_tags:
+            self.normalized = False
+        elif self.current is not None:
+            self.child("tag")
+
+    def handle_endtag(self, tag):
+        if self.current is None:
+            if tag in self.heading_tags:
+                self.normalized = False
+            return
+        if tag in self.heading_tags:
+            name, start = self.current
+            if tag != name or self.depth != 0:
+                self.normalized = False
+                return
+            end = self.subject.index(">", self.source_offset()) + 1
+            text = "".join(self.text)
+            # 與 _remove_h123_attrs 相同的判斷, 任何需要改寫的標題都交給 bs4 處理
+            if self.contents != 1:
+                self.normalized = False
+            elif self.child_kind == "tag" and text == "":
+                self.normalized = False
+            elif self.first and len(self.headings) == 0 and name != "h1":
+                self.normalized = False
+            self.headings.append((name, start, end, text.strip()))
+            self.current = None
+        else:
+            self.last_kind = "tag"
+            self.depth -= 1
+            if self.depth < 0:
+                self.normalized = False
+
+    def handle_data(self, data):
+        if self.current is not None:
+            self.child("text")
+            self.text.append(data)
+
+    def handle_comment(self, data):
+        if self.current is not None:
+            self.normalized = False
+
+    def handle_decl(self, decl):
+        if self.current is not None:
+            self.normalized = False
+
+    def handle_pi(self, data):
+        if self.current is not None:
+            self.normalized = False
+
+
+def split_content(subject):
+
+    """Split normalized content.htm into head, level and page lists in one pass
+
+    各頁面內容直接取自 subject 的字串切片, 若標題尚未正規化則傳回 None
+    """
+
+    result = split_pages(subject)
+    if result is None or len(result[1]) == 0:
+        return None
+    pages = result[1]
+    head_list = [p[0] for p in pages]
+    level_list = [p[1] for p in pages]
+    page_list = [p[3] for p in pages]
+    return head_list, level_list, page_list
+
+
+def split_pages(subject, first=True):
+
+    """Split normalized html into text before the first heading and page tuples
+
+    各頁面為 (heading, level, heading tag, page content), 若標題尚未正規化則傳回 None
+    """
+
+    splitter = HeadingSplitter(subject, first)
+    splitter.feed(subject)
+    splitter.close()
+    headings = splitter.headings
+    if not splitter.normalized or splitter.current is not None:
+        return None
+    if len(headings) == 0:
+        return subject, []
+    pages = []
+    # 原先以 str.split 逐一切割, 標題字串若提早出現 (例如在 script 內) 會切在該處
+    # 為了維持相同結果, 檢查各標題字串第一次出現的位置
+    position = 0
+    for i in range(len(headings)):
+        name, start, end, text = headings[i]
+        tag = subject[start:end]
+        if subject.find(tag, position) != start:
+            return None
+        if i < len(headings) - 1:
+            page = subject[end:headings[i+1][1]]
+        else:
+            page = subject[end:].split(tag)[0]
+        pages.append((text, name[1], tag, page))
+        position = end
+    return subject[:headings[0][1]], pages
+
+
 def remove_special_characters(text):
     
     """Removes special characters from the given text.
@@ -2133,68 +3169,115 @@ def remove_special_characters(text):
     return cleaned_text
 
 
-def render_menu(head, level, page, sitemap=0):
-    
-    """允許使用者在 h1 標題後直接加上 h3 標題, 或者隨後納入 h4 之後作為標題標註
+def menu_tree(level):
+
+    """Return the menu tree of level list, shared by render_menu, render_menu2 and render_menu3
+
+    各項目為 (opens, closes, has_children), 依標題次序記錄進入下一層 ul 或關閉幾層 li 與 ul
     """
 
-    directory = ""
+    tree = []
     # 從 level 數列第一個元素作為開端
     current_level = level[0]
-    # 若是 sitemap 則僅列出樹狀架構而沒有套用 css3menu 架構
-    if sitemap:
-        directory += "<ul>"
-    else:
-        directory += "<ul id='css3menu1' class='topmenu'>"
-    # 逐一配合 level 數列中的各標題階次, 一一建立對應的表單或 sitemap
-    for index in range(len(head)):
+    for index in range(len(level)):
         # 用 this_level 取出迴圈中逐一處理的頁面對應層級, 注意取出值為 str
         this_level = level[index]
         # 若處理中的層級比上一層級高超過一層, 則將處理層級升級 (處理 h1 後直接接 h3 情況)
         if (int(this_level) - int(current_level)) > 1:
-            #this_level = str(int(this_level) - 1)
             # 考慮若納入 h4 也作為標題標註, 相鄰層級可能大於一層, 因此直接用上一層級 + 1
             this_level = str(int(current_level) + 1)
-        # 若處理的階次比目前已經處理的階次大, 表示位階較低
-        # 其實當 level[0] 完全不會報告此一區塊
-        # 從正在處理的標題階次與前一個元素比對, 若階次低, 則要加入另一區段的 unordered list 標頭
-        # 兩者皆為 str 會轉為整數後比較
-        if this_level > current_level:
-            directory += "<ul>"
-            directory += "<li><a href='/get_page/" + head[index] + "'>" + head[index] + "</a>"
-        # 假如正在處理的標題與前一個元素同位階, 則必須再判定是否為另一個 h1 的樹狀頭
-        elif this_level == current_level:
-            # 若正在處理的標題確實為樹狀頭, 則標上樹狀頭開始標註
-            if this_level == 1:
-                # 這裡還是需要判定是在建立 sitemap 模式或者選單模式
-                if sitemap:
-                    directory += "<li><a href='/get_page/" + head[index] + "'>" + head[index]+"</a>"
-                else:
-                    directory += "<li class='topmenu'><a href='/get_page/" + head[index] + "'>" + head[index] + "</a>"
-            #  假如不是樹狀頭, 則只列出對應的 list
-            else:
-                directory += "<li><a href='/get_page/" + head[index] + "'>" + head[index] + "</a>"
+        # 兩者皆為 str, 若處理的階次比目前已經處理的階次大, 表示位階較低, 要加入另一區段的 unordered list 標頭
+        opens = this_level > current_level
         # 假如正處理的元素比上一個元素位階更高, 必須要先關掉前面的低位階區段
+        if this_level < current_level:
+            closes = int(current_level) - int(level[index])
         else:
-            directory += "</li>"*(int(current_level) - int(level[index]))
-            directory += "</ul>"*(int(current_level) - int(level[index]))
-            if this_level == 1:
-                if sitemap:
-                    directory += "<li><a href='/get_page/" + head[index] + "'>" + head[index] + "</a>"
-                else:
-                    directory += "<li class='topmenu'><a href='/get_page/" + head[index] + "'>" + head[index] + "</a>"
-            else:
-                directory += "<li><a href='/get_page/" + head[index] + "'>" + head[index] + "</a>"
+            closes = 0
+        # render_menu2 依下一個標題是否位階較低, 決定是否加上 class=has-children
+        has_children = index < len(level) - 1 and this_level < level[index+1]
+        tree.append((opens, closes, has_children))
         current_level = this_level
-    directory += "</li></ul>"
+    return tree
+
+
+def _render_menu_tree(tree, head, link_prefix, link_suffix, ul, has_children=False):
+
+    """Render li and ul tags of menu tree with the given link format
+    """
+
+    items = []
+    for index in range(len(tree)):
+        opens, closes, children = tree[index]
+        if opens:
+            items.append(ul)
+        elif closes:
+            items.append("</li>"*closes + "</ul>"*closes)
+        if has_children and children:
+            items.append("<li class='has-children'>")
+        else:
+            items.append("<li>")
+        items.append("<a href='" + link_prefix + head[index] + link_suffix + "'>" + head[index] + "</a>")
+    return "".join(items)
+
+
+def _cached_menu(key, head, level, render):
+
+    """Return menu html memoized in the current snapshot, render() when head and level are not from it
+    """
+
+    entry = _content_cache["entry"]
+    snapshot = entry[1] if entry is not None else None
+    if snapshot is None or level is not snapshot.level:
+        return render(menu_tree(level))
+    # generate_pages 使用 unique_head 產生靜態頁面選單
+    if head is snapshot.head:
+        key = ("head",) + key
+    elif head is snapshot.unique_head:
+        key = ("unique",) + key
+    else:
+        return render(snapshot.menu_tree)
+    directory = snapshot.menus.get(key)
+    if directory is None:
+        metrics.registry.inc("cmsimde_cache_misses_total", cache="menu")
+        start = time.perf_counter()
+        directory = render(snapshot.menu_tree)
+        metrics.registry.observe("cmsimde_menu_render_seconds", time.perf_counter() - start, menu=key[1])
+        snapshot.menus[key] = directory
+    else:
+        metrics.registry.inc("cmsimde_cache_hits_total", cache="menu")
     return directory
 
 
+def render_menu(head, level, page, sitemap=0):
+    
+    """允許使用者在 h1 標題後直接加上 h3 標題, 或者隨後納入 h4 之後作為標題標註
+    """
+
+    def render(tree):
+        # 若是 sitemap 則僅列出樹狀架構而沒有套用 css3menu 架構
+        if sitemap:
+            directory = "<ul>"
+        else:
+            directory = "<ul id='css3menu1' class='topmenu'>"
+        directory += _render_menu_tree(tree, head, "/get_page/", "", "<ul>")
+        return directory + "</li></ul>"
+
+    return _cached_menu(("render_menu", sitemap), head, level, render)
+
+
 def render_menu2(head, level, page, sitemap=0):
 
     """Render menu for static site
     """
 
+    return "".join(_render_menu2_parts(head, level, page, sitemap))
+
+
+def _render_menu2_parts(head, level, page, sitemap=0):
+
+    """Return header, menu list and footer of the static site menu
+    """
+
     site_title, password = parse_config()
     directory = '''
     <div class="site-wrap">
@@ -2225,11 +3308,9 @@ def render_menu2(head, level, page, sitemap=0):
                     <nav class="site-navigation position-relative text-right" role="navigation">
     '''
     
-    # 從 level 數列第一個元素作為開端, 第一個一定非 level 1 不可
-    current_level = level[0]
     # 若是 sitemap 則僅列出樹狀架構而沒有套用 css3menu 架構
     if sitemap:
-        directory += '''<ul>
+        menu = '''<ul>
 <li>
 <form>
 <div class="tipue_search_group">
@@ -2239,9 +3320,9 @@ def render_menu2(head, level, page, sitemap=0):
 </li>
         '''
     else:
-        directory += '''<ul class='site-menu js-clone-nav mr-auto d-none d-lg-block'>'''
+        menu = '''<ul class='site-menu js-clone-nav mr-auto d-none d-lg-block'>'''
     # 納入主頁與表單
-    directory += '''
+    menu += '''
                         <li class="active has-children"><a href="index.html">Home</a>
                         <ul class="dropdown">
                             <li><a href="sitemap.html">SMap</a></li>
@@ -2250,66 +3331,9 @@ def render_menu2(head, level, page, sitemap=0):
                         </ul>
                       </li>
                      '''
-    # 逐一配合 level 數列中的各標題階次, 一一建立對應的表單或 sitemap
-    for index in range(len(head)):
-        # 用 this_level 取出迴圈中逐一處理的頁面對應層級, 注意取出值為 str
-        this_level = level[index]
-        # 若處理中的層級比上一層級高超過一層, 則將處理層級升級 (處理 h1 後直接接 h3 情況)
-        if (int(this_level) - int(current_level)) > 1:
-            #this_level = str(int(this_level) - 1)
-            # 考慮若納入 h4 也作為標題標註, 相鄰層級可能大於一層, 因此直接用上一層級 + 1
-            this_level = str(int(current_level) + 1)
-        # 若處理的階次比目前已經處理的階次大, 表示位階較低
-        # 其實當 level[0] 完全不會報告此一區塊
-        # 從正在處理的標題階次與前一個元素比對, 若階次低, 則要加入另一區段的 unordered list 標頭
-        # 兩者皆為 str 會轉為整數後比較
-        # 目前的位階在上一個標題之後
-        if this_level > current_level:
-            directory += "<ul class='dropdown'>"
-            # 是否加上 class=has-children, 視下一個而定
-            # 目前處理的標題, 並不是最後一個, 因此有下一個標題待處理
-            if index < (len(head)-1):
-                next_level = level[index+1]
-                if this_level < next_level:
-                    # 表示要加上 class=dropdown
-                    directory += "<li class='has-children'><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-                else:
-                    directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-            else:
-                #表示為最後一個
-                directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-        # 假如正在處理的標題與前一個元素同位階, 則必須再判定是否為另一個 h1 的樹狀頭
-        # 目前標題與上一個標題相同
-        elif this_level == current_level:
-            # 是否加上 class=has-children, 視下一個而定
-            # 目前處理的標題, 並不是最後一個, 因此有下一個標題待處理
-            if index < (len(head)-1):
-                next_level = level[index+1]
-                if this_level < next_level:
-                    # 表示要加上 class=dropdown
-                    directory += "<li class='has-children'><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-                else:
-                    directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-            else:
-                #表示為最後一個
-                directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-        # 假如正處理的元素比上一個元素位階更高, 必須要先關掉前面的低位階區段
-        else:
-            directory += "</li>"*(int(current_level) - int(level[index]))
-            directory += "</ul>"*(int(current_level) - int(level[index]))
-            if index < (len(head)-1):
-                next_level = level[index+1]
-                if this_level < next_level:
-                    # 表示要加上 class=dropdown
-                    directory += "<li class='has-children'><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-                else:
-                    directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-            else:
-                #表示為最後一個
-                directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-        current_level = this_level
-    directory += '''</li>
-                      </ul>
+    menu_end = '''</li>
+                      </ul>'''
+    footer = '''
                 </nav>
               </div>
               <div class="d-inline-block d-xl-none ml-md-0 mr-auto py-3" style="position: relative; top: 3px;"><a href="#" class="site-menu-toggle js-menu-toggle text-black"><span class="icon-menu h3"></span></a></div>
@@ -2320,7 +3344,60 @@ def render_menu2(head, level, page, sitemap=0):
           
         </header>
     '''
-    return directory
+    # 靜態網頁各頁面使用相同選單, generate_pages 只需產生一次
+    return _cached_menu(("render_menu2", sitemap, site_title), head, level,
+                        lambda tree: (directory, menu + _render_menu_tree(tree, head, "", ".html", "<ul class='dropdown'>", True) + menu_end, footer))
+
+
+def menu_parents(level):
+
+    """Return list of parent page order of each page, None for pages at the top level
+    """
+
+    parents = []
+    stack = []
+    for index in range(len(level)):
+        while stack and int(level[stack[-1]]) >= int(level[index]):
+            stack.pop()
+        parents.append(stack[-1] if stack else None)
+        stack.append(index)
+    return parents
+
+
+def static_menu_file(head, level, page):
+
+    """Return fingerprinted file name of the external static site menu
+    """
+
+    # 每個頁面都引用選單檔, 選單的 hash 與選單一起存於 snapshot, 不必逐頁重新計算
+    return _cached_menu(("static_menu_file",), head, level,
+                        lambda tree: "menu-" + contentstore.text_hash(_render_menu2_parts(head, level, page)[1])[:12] + ".js")
+
+
+def static_menu_script(head, level, page):
+
+    """Return javascript writing the static site menu into the page where it is loaded
+    """
+
+    header, menu, footer = _render_menu2_parts(head, level, page)
+    # 同步的 document.write 讓 main.js 載入時選單已存在, 可照常複製成手機版選單
+    return "document.write(" + json.dumps(menu) + ");\n"
+
+
+def render_menu2_external(head, level, page, order):
+
+    """Render static site menu loading the shared menu file, with inline breadcrumb for browsers without javascript
+    """
+
+    header, menu, footer = _render_menu2_parts(head, level, page)
+    parents = _cached_menu(("menu_parents",), head, level, lambda tree: menu_parents(level))
+    links = []
+    while order is not None:
+        links.insert(0, "<a href='" + head[order] + ".html'>" + head[order] + "</a>")
+        order = parents[order]
+    breadcrumb = " &gt; ".join(["<a href='index.html'>Home</a>"] + links)
+    return header + "<script src=\"" + static_menu_file(head, level, page) + "\"></script><noscript>" + \
+                breadcrumb + "</noscript>" + footer
 
 
 def render_menu3(head, level, page, sitemap=0):
@@ -2328,53 +3405,18 @@ def render_menu3(head, level, page, sitemap=0):
     """Render menu for static sitemap
     """
 
-    directory = ""
-    current_level = level[0]
-    if sitemap:
-        directory += "<ul>"
-    else:
-        # before add tipue search function
-        #directory += "<ul id='css3menu1' class='topmenu'>"
-        directory += "<ul id='css3menu1' class='topmenu'><div class=\"tipue_search_group\"><input style=\"width: 6vw;\" type=\"text\" name=\"q\" id=\"tipue_search_input\" pattern=\".{2,}\" title=\"Press enter key to search\" required></div>"
-    for index in range(len(head)):
-        this_level = level[index]
-        # 若處理中的層級比上一層級高超過一層, 則將處理層級升級 (處理 h1 後直接接 h3 情況)
-        if (int(this_level) - int(current_level)) > 1:
-            #this_level = str(int(this_level) - 1)
-            this_level = str(int(current_level) + 1)
-        if this_level > current_level:
-            directory += "<ul>"
-            #directory += "<li><a href='/get_page/"+head[index]+"'>"+head[index]+"</a>"
-            # 改為連結到 content/標題.html
-            directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-        elif this_level == current_level:
-            if this_level == 1:
-                if sitemap:
-                    # 改為連結到 content/標題.html
-                    #directory += "<li><a href='/get_page/"+head[index]+"'>"+head[index]+"</a>"
-                    directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-                else:
-                    #directory += "<li class='topmenu'><a href='/get_page/"+head[index]+"'>"+head[index]+"</a>"
-                    directory += "<li class='topmenu'><a href='content/" + head[index] + ".html'>" + head[index] + "</a>"
-            else:
-                #directory += "<li><a href='/get_page/"+head[index]+"'>"+head[index]+"</a>"
-                directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
+    def render(tree):
+        if sitemap:
+            directory = "<ul>"
         else:
-            directory += "</li>"*(int(current_level) - int(level[index]))
-            directory += "</ul>"*(int(current_level) - int(level[index]))
-            if this_level == 1:
-                if sitemap:
-                    #directory += "<li><a href='/get_page/"+head[index]+"'>"+head[index]+"</a>"
-                    directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-                else:
-                    #directory += "<li class='topmenu'><a href='/get_page/"+head[index]+"'>"+head[index]+"</a>"
-                    directory += "<li class='topmenu'><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-            else:
-                #directory += "<li><a href='/get_page/"+head[index]+"'>"+head[index]+"</a>"
-                directory += "<li><a href='" + head[index] + ".html'>" + head[index] + "</a>"
-        current_level = this_level
-    directory += "</li></ul>"
-    return directory
+            # before add tipue search function
+            #directory += "<ul id='css3menu1' class='topmenu'>"
+            directory = "<ul id='css3menu1' class='topmenu'><div class=\"tipue_search_group\"><input style=\"width: 6vw;\" type=\"text\" name=\"q\" id=\"tipue_search_input\" pattern=\".{2,}\" title=\"Press enter key to search\" required></div>"
+        # 改為連結到 content/標題.html
+        directory += _render_menu_tree(tree, head, "", ".html", "<ul>")
+        return directory + "</li></ul>"
+
+    return _cached_menu(("render_menu3", sitemap), head, level, render)
 
 
 @app.route('/saveConfig', methods=['POST'])
@@ -2429,23 +3471,23 @@ def savePage():
         return redirect("/login")
     if page_content is None:
         return error_log("no content to save!")
-    # 在插入新頁面資料前, 先複製 content.htm 一分到 content_backup.htm
-    shutil.copy2(config_dir + "content.htm", config_dir + "content_backup.htm")
+    # 修改的部分由 save_content 附加於 content_journal.jsonl, 不再複製整個 content.htm
     # in Windows client operator, to avoid textarea add extra \n
     # for ajax save comment the next line
     #page_content = page_content.replace("\n","")
-    with open(config_dir + "content.htm", "w", encoding="utf-8") as f:
-        f.write(page_content)
+    save_content(page_content)
     return redirect("/edit_page")
 
 
-def search_content(head, page, search):
+def search_content(head, page, search, index=None):
 
     """Search content
     """
 
-    find = lambda searchList, elem: [[i for i, x in enumerate(searchList) if x == e] for e in elem]
-    search_result = find(head, [search])[0]
+    # 由 heading_index 建立的索引直接取得頁面次序
+    if index is None:
+        index = heading_index(head)
+    search_result = index.get(search, [])
     page_order = []
     page_content = []
     for i in range(len(search_result)):
@@ -2720,7 +3762,8 @@ def set_css2():
         <script src="../cmsimde/static/chimper/js/jquery-3.3.1.min.js"></script>
         <link rel="stylesheet" href="./../cmsimde/static/tipuesearch/css/normalize.min.css">
         <script src="./../cmsimde/static/tipuesearch/tipuesearch_set.js"></script>
-        <script src="tipuesearch_content.js"></script>
+        <script src="tipuesearch_index.js"></script>
+        <script src="./../cmsimde/static/tipuesearch/tipuesearch_shards.js"></script>
         <link rel="stylesheet" href="./../cmsimde/static/tipuesearch/css/tipuesearch.css">
         <script src="./../cmsimde/static/tipuesearch/tipuesearch.js"></script>
         <!-- for Wink3 客製化關閉 -->
@@ -2785,6 +3828,14 @@ def sitemap(edit):
     """Sitemap for dynamic site
     """
 
+    return conditional_response(content_snapshot(), ("sitemap",), _sitemap)
+
+
+def _sitemap():
+
+    """Render sitemap of dynamic site
+    """
+
     head, level, page = parse_content()
     directory = render_menu(head, level, page)
     sitemap = render_menu(head, level, page, sitemap=1)
@@ -2793,14 +3844,100 @@ def sitemap(edit):
              "</section></div></body></html>"
 
 
-def sitemap2(head):
+def save_content(subject, page_order=None):
+
+    """Normalize headings and write subject into content.htm
+
+    修改的部分附加於 journal, page_order 為單頁編輯時的頁面次序
+    """
+
+    # 標題正規化只在存檔時進行, 讀取 content.htm 的各 request 不會寫檔
+    subject = normalize_content(subject)
+    with _content_lock:
+        offset, old, new = contentstore.text_delta(_stored_source(), subject)
+        if old != "" or new != "":
+            journal.append(page_order, offset, old, new)
+        _write_source(subject)
+    return subject
+
+
+def save_page(page_order, page_content):
+
+    """Save one page and update the cached snapshot without parsing the other pages
+
+    傳回更新後的 ContentSnapshot, 無法單獨切割的頁面傳回 None, 由呼叫者改寫全部頁面
+    """
+
+    # 與 save_content 相同以 bs4 輸出, 但只處理編輯的頁面
+    subject = str(beautiful_soup(page_content, "html.parser"))
+    subject = subject.replace("\r\n", "\n").replace("\r", "\n")
+    result = split_pages(subject, page_order == 0)
+    if result is None:
+        return None
+    prefix, pages = result
+    # 最後一頁在重複的標題處截斷時, 無法保留全部內容
+    if prefix + "".join(tag + html for heading, level, tag, html in pages) != subject:
+        return None
+    # 第一頁之前沒有上一頁可以併入, 交給 save_content 正規化處理
+    if page_order == 0 and (prefix != "" or len(pages) == 0):
+        return None
+    store = page_store()
+    with _content_lock:
+        snapshot = content_snapshot()
+        if isinstance(snapshot, str) or snapshot.tag is None or page_order >= len(snapshot.head):
+            return None
+        # 第一個標題之前的內容併入上一頁, 改寫範圍由上一頁開始
+        first = page_order - 1 if prefix else page_order
+        new_pages = [(p[0], p[1], p[2], p[3]) for p in pages]
+        if prefix:
+            new_pages.insert(0, (snapshot.head[first], snapshot.level[first], snapshot.tag[first],
+                                          snapshot.page[first] + prefix))
+        # 標題以第一次出現的位置切割, 前後相鄰頁面內容不可包含下一個標題標註
+        neighbours = new_pages[:]
+        if first > 0:
+            neighbours.insert(0, (None, None, None, snapshot.page[first-1]))
+        if page_order + 1 < len(snapshot.head):
+            neighbours.append((None, None, snapshot.tag[page_order+1], None))
+        for i in range(1, len(neighbours)):
+            if neighbours[i][2] in neighbours[i-1][3]:
+                return None
+        head = snapshot.head[:first] + [p[0] for p in new_pages] + snapshot.head[page_order+1:]
+        level = snapshot.level[:first] + [p[1] for p in new_pages] + snapshot.level[page_order+1:]
+        tag = snapshot.tag[:first] + [p[2] for p in new_pages] + snapshot.tag[page_order+1:]
+        page = snapshot.page[:first] + [p[3] for p in new_pages] + snapshot.page[page_order+1:]
+        if len(head) == 0:
+            return None
+        offset = sum(len(tag[i]) + len(page[i]) for i in range(first))
+        old = "".join(snapshot.tag[i] + snapshot.page[i] for i in range(first, page_order + 1))
+        new = "".join(p[2] + p[3] for p in new_pages)
+        if store is None:
+            contentstore.write_file(config_dir + "content.htm", "".join(tag[i] + page[i] for i in range(len(head))))
+        else:
+            store.replace_page(page_order, prefix, pages)
+        journal.append(page_order, offset, old, new)
+        bump_content_version()
+        # 直接以更新後的數列建立 snapshot, 不必重新解析 content.htm
+        key = _content_key()
+        if key is None:
+            return None
+        snapshot = ContentSnapshot(head, level, page, key, tag)
+        _content_cache["entry"] = (key, snapshot)
+    return snapshot
+
+
+def sitemap2(head, snapshot=None):
 
     """Sitemap for static content generation
     """
 
     edit = 0
-    not_used_head, level, page = parse_content()
-    directory = render_menu2(head, level, page)
+    if snapshot is None:
+        snapshot = content_snapshot()
+    level, page = snapshot.level, snapshot.page
+    if getattr(init.Init, "static_menu", "inline") == "external":
+        directory = render_menu2_external(head, level, page, None)
+    else:
+        directory = render_menu2(head, level, page)
     # 先改為使用 render_menu3 而非 render_menu2
     sitemap = render_menu3(head, level, page, sitemap=1)
     # add tipue search id
@@ -2849,30 +3986,33 @@ def ssavePage():
     # for ajax save comment the next line
     #page_content = page_content.replace("\n","")
     head, level, page = parse_content()
+    updated = None
     original_head_title = head[int(page_order)]
-    # 在插入新頁面資料前, 先複製 content.htm 一分到 content_backup.htm
-    shutil.copy2(config_dir + "content.htm", config_dir + "content_backup.htm")
     if page_content != "":
-        with open(config_dir + "content.htm", "w", encoding="utf-8") as file:
+        if action == "save":
+            newContent = page_content
+        else:
+            # make orig and new html content into list
+            newSoup = beautiful_soup(page_content, "html.parser")
+            newList =[str(tag) for tag in newSoup.find_all(['h1', 'h2', 'h3', 'h4', 'p', 'pre', 'ol', 'ul', 'script', 'table'])]
+            oldPage = page[int(page_order)]
+            oldSoup = beautiful_soup(oldPage, "html.parser")
+            oldList =[snTosr(tag) for tag in oldSoup.find_all(['h1', 'h2', 'h3', 'h4', 'p', 'pre', 'ol', 'ul', 'script', 'table'])]
+            mergedList = merge_sequences(oldList, newList)
+            newContent = ""
+            for i in range(len(mergedList)):
+                newContent += mergedList[i]
+        # 只切割編輯的頁面並更新 snapshot, 頁面儲存時只改寫該頁面
+        updated = save_page(int(page_order), newContent)
+        if updated is None:
+            content = []
             for index in range(len(head)):
                 if index == int(page_order):
-                    if action == "save":
-                        file.write(page_content)
-                    else:
-                        # make orig and new html content into list
-                        newSoup = bs4.BeautifulSoup(page_content, "html.parser")
-                        newList =[str(tag) for tag in newSoup.find_all(['h1', 'h2', 'h3', 'h4', 'p', 'pre', 'ol', 'ul', 'script', 'table'])]
-                        oldPage = page[index]
-                        oldSoup = bs4.BeautifulSoup(oldPage, "html.parser")
-                        oldList =[snTosr(tag) for tag in oldSoup.find_all(['h1', 'h2', 'h3', 'h4', 'p', 'pre', 'ol', 'ul', 'script', 'table'])]
-                        mergedList = merge_sequences(oldList, newList)
-                        newContent = ""
-                        for i in range(len(mergedList)):
-                            newContent += mergedList[i]
-                        file.write(newContent)
+                    content.append(newContent)
                 else:
-                    file.write("<h"+str(level[index])+ ">" + str(head[index]) + "</h" + \
-                                  str(level[index])+">"+str(page[index]))
+                    content.append("<h"+str(level[index])+ ">" + str(head[index]) + "</h" + \
+                                      str(level[index])+">"+str(page[index]))
+            save_content("".join(content), int(page_order))
     else:
         return error_log("Error: no content to save!")
     # if every ssavePage generate_pages needed
@@ -2880,7 +4020,10 @@ def ssavePage():
 
     # if head[int(page_order)] still existed and equal original_head_title, go back to origin edit status, otherwise go to "/"
     # here the content is modified, we need to parse the new page_content again
-    head, level, page = parse_content()
+    if updated is None:
+        head, level, page = parse_content()
+    else:
+        head = updated.head
     # for debug
     # print(original_head_title, head[int(page_order)])
     # 嘗試避免因最後一個標題刪除儲存後產生 internal error 問題
@@ -2903,6 +4046,9 @@ def start_static():
     """Start local static server in https with IPv4/IPv6 support"""
     
     if isAdmin():
+        # 只有啟動靜態網站時才需要
+        import http.server
+        import ssl
         try:
             # 使用 init.py 中所設定的 IP address
             server_address = init.Init.ip
@@ -3063,7 +4209,6 @@ def tinymce_editor(menu_input=None, editor_content=None, page_order=None):
     """Tinymce editor scripts
     """
 
-    sitecontent =file_get_contents(config_dir + "content.htm")
     editor = set_admin_css() + editorhead() + '''</head>''' + editorfoot()
     # edit all pages
     if page_order is None:
@@ -3302,4 +4447,32 @@ def snTosr(tag):
     else:
         return tagStr
 if __name__ == "__main__":
-    app.run()
+    # 轉出靜態網頁與 rollback 使用 python3 -m cmsimde build 與 python3 -m cmsimde rollback
+    # python3 cmsimde/flaskapp.py normalize 可將既有 content.htm 的標題一次正規化
+    if len(sys.argv) > 1 and sys.argv[1] == "normalize":
+        if normalize_content_file():
+            print("content.htm normalized, original saved to content_backup.htm")
+        else:
+            print("content.htm already normalized")
+    # init.py 設定 content_store = "shard" 或 "sqlite" 後, 以 import 將 content.htm 匯入頁面儲存, export 則匯出為 content.htm
+    elif len(sys.argv) > 1 and sys.argv[1] == "import":
+        if import_content():
+            print("content.htm imported into " + content_store + " page store")
+        else:
+            print("content_store is htm, nothing to import")
+    elif len(sys.argv) > 1 and sys.argv[1] == "export":
+        if export_content():
+            print("page store exported to content.htm")
+        else:
+            print("no page store to export")
+    # undo 依 content_journal.jsonl 回復最後一次修改, compact 只保留最後 journal_keep 筆記錄
+    elif len(sys.argv) > 1 and sys.argv[1] == "undo":
+        entry = undo_content()
+        if entry is None:
+            print("nothing to undo")
+        else:
+            print("reverted change saved at " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["time"])))
+    elif len(sys.argv) > 1 and sys.argv[1] == "compact":
+        print(str(journal.compact()) + " journal entries compacted")
+    else:
+        app.run()
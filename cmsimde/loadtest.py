@@ -0,0 +1,331 @@
+# coding: utf-8
+
+"""Load test the dynamic site with concurrent browsing, editing, image listing and searching
+
+python3 cmsimde/loadtest.py [--concurrency N ...] [--duration S] [--mix browse=70,search=10,images=10,edit=10]
+                            [--threads N] [--url URL --password PASSWORD] [--json FILE]
+
+未指定 --url 時, 以另一個程序在本機啟動 flaskapp.app (有安裝 waitress 則使用 waitress),
+該程序使用 config 目錄的暫存複本與隨機管理者密碼, 編輯存檔不會改到原本的網站內容
+edit 載入單頁編輯器後將頁面原封不動以 ssavePage 存回, 指定 --url 時需提供 --password 才會執行管理者動作
+"""
+
+import os
+import re
+import sys
+import json
+import html
+import time
+import random
+import logging
+import shutil
+import socket
+import signal
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import urllib.error
+import urllib.request
+import http.cookiejar
+
+currentdir = os.path.dirname(os.path.abspath(__file__))
+
+MIX = {"browse": 70, "search": 10, "images": 10, "edit": 10}
+# 需要管理者登入的動作
+ADMIN = ("search", "images", "edit")
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+
+    """Return redirect responses instead of following them, each route is measured by itself
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Client(object):
+
+    """HTTP client keeping the session cookie of one simulated user
+
+    latencies 依 route 記錄每個 request 的秒數, errors 記錄狀態碼 400 以上或連線失敗的次數
+    """
+
+    def __init__(self, base, latencies, errors):
+        self.base = base
+        self.latencies = latencies
+        self.errors = errors
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                                  NoRedirect())
+
+    def request(self, route, path, data=None):
+
+        """Request path and record its latency under route, return (status, headers, body)
+        """
+
+        if data is not None:
+            data = urllib.parse.urlencode(data).encode("utf-8")
+        start = time.perf_counter()
+        try:
+            with self.opener.open(self.base + path, data, timeout=60) as response:
+                status, headers, body = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            status, headers, body = e.code, e.headers, e.read()
+        except (OSError, ValueError):
+            status, headers, body = None, {}, b""
+        self.latencies.setdefault(route, []).append(time.perf_counter() - start)
+        if status is None or status >= 400:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        return status, headers, body.decode("utf-8", "replace")
+
+
+def discover(base):
+
+    """Return headings listed in the sitemap of the dynamic site
+    """
+
+    with urllib.request.urlopen(base + "/sitemap", timeout=60) as response:
+        sitemap = response.read().decode("utf-8", "replace")
+    headings = re.findall("href='/get_page/([^']+)'", sitemap)
+    # 重複標題只需保留一個
+    return list(dict.fromkeys(html.unescape(heading) for heading in headings))
+
+
+def browse(user, rand, headings):
+    user["anonymous"].request("GET /get_page/<heading>", "/get_page/" + urllib.parse.quote(rand.choice(headings)))
+
+
+def search(user, rand, headings):
+    keyword = rand.choice(rand.choice(headings).split() or ["a"])
+    user["admin"].request("POST /doSearch", "/doSearch", {"keyword": keyword})
+
+
+def images(user, rand, headings):
+    user["admin"].request("GET /image_list", "/image_list?page=" + str(rand.randint(1, 3)) + "&item_per_page=10")
+
+
+def edit(user, rand, headings):
+    admin = user["admin"]
+    status, headers, body = admin.request("GET /get_page/<heading>/1", "/get_page/" + urllib.parse.quote(rand.choice(headings)) + "/1")
+    editor = re.search("id='page_content'[^>]*>(.*?)</textarea><input type='hidden'  id='page_order' name='page_order' value='([0-9]+)'",
+                       body, re.S)
+    if editor is None:
+        return
+    admin.request("POST /ssavePage", "/ssavePage", {"page_content": html.unescape(editor.group(1)), "page_order": editor.group(2)})
+
+
+SCENARIOS = {"browse": browse, "search": search, "images": images, "edit": edit}
+
+
+def worker(base, password, mix, headings, deadline, seed, latencies, errors):
+
+    """Run scenarios chosen by their weight in mix until deadline
+    """
+
+    rand = random.Random(seed)
+    user = {"anonymous": Client(base, latencies, errors), "admin": None}
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    while time.perf_counter() < deadline:
+        name = rand.choices(names, weights)[0]
+        if name in ADMIN and user["admin"] is None:
+            # 每個模擬使用者只登入一次
+            user["admin"] = Client(base, latencies, errors)
+            user["admin"].request("POST /checkLogin", "/checkLogin", {"password": password})
+        SCENARIOS[name](user, rand, headings)
+
+
+def login(base, password):
+
+    """Return True if password logs in as admin
+    """
+
+    status, headers, body = Client(base, {}, {}).request("POST /checkLogin", "/checkLogin", {"password": password})
+    # 登入成功導向 /edit_page, 失敗導向 /
+    return headers.get("Location", "").endswith("/edit_page")
+
+
+def percentile(values, p):
+
+    """Return the nearest rank percentile p of sorted values
+    """
+
+    return values[max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def run_level(base, password, mix, headings, concurrency, duration):
+
+    """Run concurrency workers for duration seconds, return throughput and latency of each route
+    """
+
+    deadline = time.perf_counter() + duration
+    results = [({}, {}) for i in range(concurrency)]
+    threads = [threading.Thread(target=worker, args=(base, password, mix, headings, deadline, i) + results[i])
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    # 各執行緒分別記錄, 結束後才合併, 量測時不需要 lock
+    latencies = {}
+    errors = {}
+    for thread_latencies, thread_errors in results:
+        for route in thread_latencies:
+            latencies.setdefault(route, []).extend(thread_latencies[route])
+        for route in thread_errors:
+            errors[route] = errors.get(route, 0) + thread_errors[route]
+    routes = {}
+    for route in sorted(latencies):
+        values = sorted(latencies[route])
+        routes[route] = {"count": len(values), "errors": errors.get(route, 0), "rps": len(values) / elapsed,
+                         "p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99)}
+    requests = sum(route["count"] for route in routes.values())
+    return {"concurrency": concurrency, "duration": elapsed, "requests": requests, "rps": requests / elapsed,
+            "errors": sum(errors.values()), "routes": routes}
+
+
+def print_level(level):
+    print("concurrency %d, %.1f s, %d requests, %.1f req/s, %d errors" % (level["concurrency"], level["duration"],
+                                                                       level["requests"], level["rps"], level["errors"]))
+    print("%-28s %7s %7s %8s %9s %9s %9s" % ("route", "count", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for route, stats in level["routes"].items():
+        print("%-28s %7d %7d %8.1f %9.1f %9.1f %9.1f" % (route, stats["count"], stats["errors"], stats["rps"],
+                                                         stats["p50"] * 1000, stats["p95"] * 1000, stats["p99"] * 1000))
+    print("")
+
+
+def serve(port, password, threads):
+
+    """Serve flaskapp.app on port with a temporary copy of the config directory until terminated
+    """
+
+    sys.path.insert(0, currentdir)
+    import flaskapp
+    import contentstore
+    site_dir = tempfile.mkdtemp(prefix="cmsimde_loadtest_")
+    try:
+        config_dir = os.path.join(site_dir, "config") + "/"
+        shutil.copytree(flaskapp.config_dir, config_dir,
+                        ignore=shutil.ignore_patterns("content_journal.jsonl", "*_backup.htm", "build_manifest*"))
+        with open(config_dir + "config", "w", encoding="utf-8") as f:
+            f.write(hashlib.sha512(password.encode("utf-8")).hexdigest())
+        flaskapp.config_dir = config_dir
+        flaskapp.journal = contentstore.Journal(config_dir + "content_journal.jsonl", flaskapp.journal.keep)
+        flaskapp._page_store["store"] = None
+        flaskapp.bump_content_version()
+        # terminate() 時執行 finally 刪除暫存目錄
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            import waitress
+            waitress.serve(flaskapp.app, listen="127.0.0.1:" + str(port), threads=threads, _quiet=True)
+        except ImportError:
+            from werkzeug.serving import make_server
+            # 不輸出每個 request 的記錄
+            logging.getLogger("werkzeug").setLevel(logging.ERROR)
+            make_server("127.0.0.1", port, flaskapp.app, threaded=True).serve_forever()
+    finally:
+        flaskapp.journal.close()
+        shutil.rmtree(site_dir, ignore_errors=True)
+
+
+def start_server(threads):
+
+    """Start serve() in a child process, return (process, base url, admin password)
+    """
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    password = hashlib.sha1(os.urandom(16)).hexdigest()
+    # 伺服器與負載產生器分屬不同程序, 不會互相搶 GIL
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port), password, str(threads)])
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process, "http://127.0.0.1:" + str(port), password
+        except OSError:
+            if process.poll() is not None:
+                break
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("flaskapp server did not start")
+
+
+def parse_mix(text):
+
+    """Return dict of scenario weights from browse=70,search=10 format
+    """
+
+    mix = {}
+    for item in text.split(","):
+        name, sep, weight = item.partition("=")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError("unknown scenario " + repr(name) + ", use " + ", ".join(SCENARIOS))
+        if not weight.isdigit():
+            raise argparse.ArgumentTypeError("weight of " + name + " must be a non negative integer, got " + repr(weight))
+        mix[name] = int(weight)
+    return mix
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["--serve"]:
+        # start_server() 以 --serve 啟動伺服器程序, 不列在說明中
+        parser = argparse.ArgumentParser(prog="python3 cmsimde/loadtest.py --serve")
+        parser.add_argument("port", type=int)
+        parser.add_argument("password")
+        parser.add_argument("threads", type=int)
+        args = parser.parse_args(argv[1:])
+        serve(args.port, args.password, args.threads)
+        return 0
+    parser = argparse.ArgumentParser(prog="python3 cmsimde/loadtest.py", description="cmsimde dynamic site load test")
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32], metavar="N",
+                        help="simulated users of each run, default 1 8 32")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of each run, default 30")
+    parser.add_argument("--mix", type=parse_mix, default=dict(MIX),
+                        help="scenario weights, default " + ",".join(name + "=" + str(MIX[name]) for name in MIX))
+    parser.add_argument("--threads", type=int, default=8, help="threads of the local server, default 8")
+    parser.add_argument("--url", help="load test a running site instead of a local server")
+    parser.add_argument("--password", help="admin password of --url, admin scenarios are skipped without it")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    mix = args.mix
+    process = None
+    base, password = args.url, args.password
+    if base is None:
+        process, base, password = start_server(args.threads)
+    base = base.rstrip("/")
+    try:
+        if password is None:
+            # 沒有管理者密碼時只能瀏覽頁面
+            mix = dict((name, weight) for name, weight in mix.items() if name not in ADMIN)
+        elif not login(base, password):
+            print("admin login failed, check --password", file=sys.stderr)
+            return 1
+        headings = discover(base)
+        if not headings:
+            print("no pages found in " + base + "/sitemap", file=sys.stderr)
+            return 1
+        report = {"url": args.url, "mix": mix, "time": time.strftime("%Y-%m-%d %H:%M:%S"), "levels": []}
+        for concurrency in args.concurrency:
+            level = run_level(base, password, mix, headings, concurrency, args.duration)
+            print_level(level)
+            report["levels"].append(level)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=1)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+# coding: utf-8
+
+"""Request timing middleware and counters of the dynamic site in Prometheus text format
+
+各程序分別記錄, 以 uwsgi 等多程序方式執行時, /metrics 只傳回處理該 request 的程序的數值
+"""
+
+import time
+import bisect
+import threading
+
+# request 秒數 histogram 的上限 (le)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels):
+
+    """Return {name="value",...} of sorted label pairs, empty string without labels
+    """
+
+    if not labels:
+        return ""
+    return "{" + ",".join(name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                          for name, value in labels) + "}"
+
+
+class Histogram(object):
+
+    """Cumulative bucket counts, sum and count of observed values
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+
+    """Thread safe counters, gauges and histograms keyed by metric name and labels
+
+    describe() 設定各 metric 的 HELP 與 TYPE, render() 傳回 Prometheus text format
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.help = {}
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.metrics.setdefault(name, {})
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.metrics.setdefault(name, {})[key] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self.metrics.setdefault(name, {})
+            histogram = samples.get(key)
+            if histogram is None:
+                histogram = samples[key] = Histogram()
+            histogram.observe(value)
+
+    def ratio(self, name, hits, misses):
+
+        """Set gauge name to hits / (hits + misses) for each label set of the two counters
+        """
+
+        with self.lock:
+            hit_samples = self.metrics.get(hits, {})
+            miss_samples = self.metrics.get(misses, {})
+            for key in set(hit_samples) | set(miss_samples):
+                lookups = hit_samples.get(key, 0) + miss_samples.get(key, 0)
+                if lookups:
+                    self.metrics.setdefault(name, {})[key] = hit_samples.get(key, 0) / lookups
+
+    def clear(self):
+        with self.lock:
+            self.metrics.clear()
+
+    def render(self):
+
+        """Return all metrics in Prometheus text exposition format
+        """
+
+        lines = []
+        with self.lock:
+            for name in sorted(self.metrics):
+                kind, text = self.help.get(name, ("untyped", name))
+                lines.append("# HELP " + name + " " + text)
+                lines.append("# TYPE " + name + " " + kind)
+                for key, value in sorted(self.metrics[name].items()):
+                    if not isinstance(value, Histogram):
+                        lines.append(name + format_labels(key) + " " + repr(value))
+                        continue
+                    cumulative = 0
+                    for le, count in zip(value.buckets + ("+Inf",), value.counts):
+                        cumulative += count
+                        lines.append(name + "_bucket" + format_labels(key + (("le", le),)) + " " + str(cumulative))
+                    lines.append(name + "_sum" + format_labels(key) + " " + repr(value.sum))
+                    lines.append(name + "_count" + format_labels(key) + " " + str(value.count))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+registry.describe("cmsimde_http_requests_total", "counter", "Requests by route, method and status")
+registry.describe("cmsimde_http_request_duration_seconds", "histogram", "Request latency by route")
+registry.describe("cmsimde_http_request_bytes_total", "counter", "Request body bytes by route")
+registry.describe("cmsimde_http_response_bytes_total", "counter", "Response body bytes by route")
+registry.describe("cmsimde_cache_hits_total", "counter", "Cache hits by cache")
+registry.describe("cmsimde_cache_misses_total", "counter", "Cache misses by cache")
+registry.describe("cmsimde_cache_hit_ratio", "gauge", "Cache hits divided by lookups by cache")
+registry.describe("cmsimde_content_parse_seconds", "histogram", "Time spent parsing the content store")
+registry.describe("cmsimde_menu_render_seconds", "histogram", "Time spent rendering uncached menus by menu")
+registry.describe("cmsimde_file_writes_total", "counter", "Files written through contentstore.write_file")
+registry.describe("cmsimde_file_write_bytes_total", "counter", "Characters written through contentstore.write_file")
+
+
+class ResponseBody(object):
+
+    """Wrap a WSGI response iterable, count its bytes and call done(bytes) when it is closed
+    """
+
+    def __init__(self, body, done):
+        self.body = body
+        self.done = done
+        self.bytes = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.done(self.bytes)
+
+
+class MetricsMiddleware(object):
+
+    """WSGI middleware recording count, latency and sizes of each request under its Flask url rule
+
+    mode 為 "basic" 時回應大小取自 Content-Length, 於 Flask 傳回回應時結束計時;
+    "full" 則逐段計算串流回應的大小, 並計時至回應完全送出
+    """
+
+    def __init__(self, app, registry=registry, mode="basic"):
+        self.app = app
+        self.registry = registry
+        self.mode = mode
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        response = {"status": "500", "length": None}
+
+        def metrics_start_response(status, headers, exc_info=None):
+            response["status"] = status.split(" ", 1)[0]
+            for name, value in headers:
+                if name.lower() == "content-length":
+                    response["length"] = int(value)
+            return start_response(status, headers, exc_info)
+
+        def done(length):
+            # url rule 由 before_request 寫入 environ, 不符合任何 route 時以 <unmatched> 記錄
+            route = environ.get("cmsimde.route", "<unmatched>")
+            self.registry.inc("cmsimde_http_requests_total", route=route, method=environ.get("REQUEST_METHOD", ""),
+                              status=response["status"])
+            self.registry.observe("cmsimde_http_request_duration_seconds", time.perf_counter() - start, route=route)
+            request_length = environ.get("CONTENT_LENGTH")
+            if request_length and request_length.isdigit():
+                self.registry.inc("cmsimde_http_request_bytes_total", int(request_length), route=route)
+            if length:
+                self.registry.inc("cmsimde_http_response_bytes_total", length, route=route)
+
+        try:
+            body = self.app(environ, metrics_start_response)
+        except Exception:
+            done(None)
+            raise
+        if self.mode == "full":
+            return ResponseBody(body, done)
+        done(response["length"])
+        return body
+
+
+def install(app, mode="basic"):
+
+    """Record metrics of the Flask app unless mode is "off"
+    """
+
+    if mode == "off":
+        return
+    # contentstore 也使用本模組計算寫檔次數, 只在此處需要 flask
+    from flask import request
+
+    @app.before_request
+    def metrics_route():
+        if request.url_rule is not None:
+            request.environ["cmsimde.route"] = request.url_rule.rule
+
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, registry, mode)
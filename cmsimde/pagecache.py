@@ -0,0 +1,87 @@
+# coding: utf-8
+
+"""LRU cache of rendered page html shared by the flaskapp routes
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+
+def value_size(value):
+
+    """Return approximate memory size in bytes of cached str, list or tuple value
+    """
+
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(value_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class PageCache(object):
+
+    """Bounded LRU cache evicting the least recently used pages by total size in bytes
+
+    hits, misses 與 evictions 記錄快取使用情形, max_bytes 為 0 時不快取
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+
+        """Return cached value of key and mark it as recently used, None if not cached
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+
+        """Cache value of key, evict least recently used entries beyond max_bytes
+        """
+
+        size = value_size(value)
+        # 單一頁面超過上限時不快取
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted_key, (evicted, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+
+        """Remove all entries, counters are kept
+        """
+
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+
+        """Return dict of cache counters
+        """
+
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                        "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,179 @@
+# coding: utf-8
+
+"""On demand profiling of dynamic site requests with cProfile or a stack sampler
+
+管理者指定接下來 N 個 request (可限定 route) 以 cProfile 或取樣方式執行,
+結果存於 profiles/ 目錄, cProfile 為 .pstats, 取樣為 flamegraph.pl 可讀取的 .collapsed
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import threading
+
+KINDS = ("cprofile", "sample")
+# Python 3.12 起 cProfile 作用於整個程序, 同一時間只能有一個 cProfile
+_cprofile_lock = threading.Lock()
+
+
+class CProfileSession(object):
+
+    """cProfile started in the current thread
+
+    Python 3.11 以前只記錄目前的執行緒, 3.12 起則包含同一時間其他執行緒的呼叫;
+    其他剖析工具已在執行時 enable() 產生 ValueError
+    """
+
+    extension = ".pstats"
+
+    def __init__(self):
+        # 與 pstats 相同, 只在剖析時才 import
+        import cProfile
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        _cprofile_lock.release()
+
+    def write(self, filename):
+        self.profile.dump_stats(filename)
+
+
+class SampleSession(object):
+
+    """Sample the stack of the current thread every interval seconds from a background thread
+
+    取樣的負擔不隨函式呼叫次數增加, 適合 cProfile 會明顯拖慢的 request
+    """
+
+    extension = ".collapsed"
+
+    def __init__(self, interval=0.005):
+        self.thread_id = threading.get_ident()
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                names.append(os.path.basename(code.co_filename) + ":" + code.co_name + ":" + str(code.co_firstlineno))
+                frame = frame.f_back
+            stack = ";".join(reversed(names))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def write(self, filename):
+        with open(filename, "w", encoding="utf-8") as f:
+            for stack in sorted(self.stacks):
+                f.write(stack + " " + str(self.stacks[stack]) + "\n")
+
+
+class Profiler(object):
+
+    """Hand out profiling sessions to the requests chosen by arm() and keep their results in directory
+
+    remaining 為尚待剖析的 request 數, route 為 None 時不限定 route, 只保留最新的 keep 個結果
+    """
+
+    def __init__(self, directory, keep=50):
+        self.directory = directory
+        self.keep = keep
+        self.remaining = 0
+        self.route = None
+        self.kind = KINDS[0]
+        self.lock = threading.Lock()
+
+    def arm(self, count, route=None, kind="cprofile"):
+        with self.lock:
+            self.remaining = count
+            self.route = route or None
+            self.kind = kind if kind in KINDS else KINDS[0]
+
+    def take(self, route):
+
+        """Return profiling kind if the request of route should be profiled, None otherwise
+        """
+
+        with self.lock:
+            if self.remaining <= 0 or (self.route is not None and route != self.route):
+                return None
+            self.remaining -= 1
+            return self.kind
+
+    def start(self, kind):
+
+        """Return a new session of kind, a SampleSession when cProfile is already in use
+        """
+
+        if kind == "sample" or not _cprofile_lock.acquire(blocking=False):
+            return SampleSession()
+        try:
+            return CProfileSession()
+        except ValueError:
+            # sys.monitoring 已被其他剖析或除錯工具使用
+            _cprofile_lock.release()
+            return SampleSession()
+
+    def save(self, session, method, route, elapsed):
+
+        """Stop session, write its result and return the file name
+        """
+
+        session.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        # 檔名依序為時間, method, route 與毫秒數
+        name = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + "-%06d" % (now % 1 * 1000000) + "_" + method + "_" + \
+               re.sub("[^0-9A-Za-z]+", "-", route).strip("-") + "_" + str(int(elapsed * 1000)) + "ms" + session.extension
+        session.write(os.path.join(self.directory, name))
+        for old in self.profiles()[self.keep:]:
+            os.remove(os.path.join(self.directory, old))
+        return name
+
+    def profiles(self):
+
+        """Return saved profile file names, newest first
+        """
+
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted((name for name in os.listdir(self.directory) if name.endswith((".pstats", ".collapsed"))),
+                      reverse=True)
+
+    def top(self, name, limit=30):
+
+        """Return text of the functions with the largest cumulative time in profile name
+        """
+
+        filename = os.path.join(self.directory, name)
+        if name.endswith(".pstats"):
+            import pstats
+            output = io.StringIO()
+            pstats.Stats(filename, stream=output).strip_dirs().sort_stats("cumulative").print_stats(limit)
+            return output.getvalue()
+        # 取樣結果以包含子函式的取樣次數排序
+        total = 0
+        inclusive = {}
+        with open(filename, encoding="utf-8") as f:
+            for line in f:
+                stack, count = line.rstrip("\n").rsplit(" ", 1)
+                count = int(count)
+                total += count
+                for function in set(stack.split(";")):
+                    inclusive[function] = inclusive.get(function, 0) + count
+        lines = ["%d samples" % total, "", "%8s %7s  %s" % ("samples", "%", "function")]
+        for function, count in sorted(inclusive.items(), key=lambda item: -item[1])[:limit]:
+            lines.append("%8d %6.1f%%  %s" % (count, 100.0 * count / total, function))
+        return "\n".join(lines)
@@ -0,0 +1,155 @@
+# coding: utf-8
+
+"""Term sharded inverted index loaded on demand by the Tipue search of static sites
+
+tipuesearch_index.js 只記錄版本與頁數, 搜尋時 tipuesearch_shards.js 才依查詢字詞載入
+tipuesearch/ 目錄中的 t_*.js (字詞對應頁面) 與 d_*.js (頁面內容)
+"""
+
+import os
+import re
+import json
+
+import contentstore
+
+# 中日韓文字逐字索引, 其他文字以連續的字母與數字為一個字詞
+CJK = "\u2e80-\u2fdf\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+TERMS = re.compile("[" + CJK + "]|(?:(?![" + CJK + "])[^\\W_])+")
+CJK_TERM = re.compile("[" + CJK + "]")
+
+
+def terms(text):
+
+    """Return set of lower case index terms in text
+    """
+
+    return set(TERMS.findall(text.lower()))
+
+
+def shard_key(term):
+
+    """Return shard of term, a CJK character itself or the first two characters of other terms
+    """
+
+    if CJK_TERM.match(term):
+        return term
+    return term[:2]
+
+
+def shard_name(key):
+
+    """Return file name of shard key, hex code points keep the name ascii
+    """
+
+    return "t_" + "_".join("%x" % ord(c) for c in key) + ".js"
+
+
+def write_if_changed(filename, data):
+
+    """Write data into filename unless the file already holds the same text, return True if written
+    """
+
+    if os.path.isfile(filename):
+        with open(filename, encoding="utf-8") as f:
+            if f.read() == data:
+                return False
+    contentstore.write_file(filename, data)
+    return True
+
+
+class IndexWriter(object):
+
+    """Write search entries of pages into a sharded index under directory
+
+    頁面內容每 docs 頁寫成一個 d_*.js, 字詞索引在 close() 時依 shard 寫出
+    written, unchanged 與 deleted 為相對於 directory 所在目錄的檔案名稱
+    """
+
+    def __init__(self, directory, index_name="tipuesearch_index.js", base="tipuesearch/", docs=50):
+        self.directory = directory
+        self.index_name = index_name
+        self.base = base
+        self.docs = docs
+        self.count = 0
+        self.postings = {}
+        self.files = []
+        self.digests = []
+        self.written = []
+        self.unchanged = []
+        self.deleted = []
+        self.doc_writer = None
+        os.makedirs(os.path.join(directory, base), exist_ok=True)
+
+    def add(self, entry):
+
+        """Add entry dict with title, text, tags and url of the next page
+        """
+
+        doc = self.count
+        if doc % self.docs == 0:
+            self._close_docs()
+            name = "d_" + str(doc // self.docs) + ".js"
+            self.doc_writer = (name, contentstore.JSONListWriter(os.path.join(self.directory, self.base, name),
+                                                                  "tipuesearch_docs(" + str(doc // self.docs) + ", ", ");"))
+        self.doc_writer[1].write(entry)
+        # Tipue 也比對標題, 分類與網址, 一起列入索引
+        text = " ".join([entry.get("title", ""), entry.get("text", ""), entry.get("tags", ""), entry.get("url", "")])
+        for term in terms(text):
+            self.postings.setdefault(term, []).append(doc)
+        self.count += 1
+
+    def _close_docs(self):
+        if self.doc_writer is None:
+            return
+        name, writer = self.doc_writer
+        digest = writer.close()
+        filename = os.path.join(self.directory, self.base, name)
+        old = None
+        if os.path.isfile(filename):
+            with open(filename, encoding="utf-8") as f:
+                old = contentstore.text_hash(f.read())
+        if old == digest:
+            writer.discard()
+            self.unchanged.append(self.base + name)
+        else:
+            writer.commit()
+            self.written.append(self.base + name)
+        self.files.append(name)
+        self.digests.append(digest)
+        self.doc_writer = None
+
+    def _write(self, name, data):
+        if write_if_changed(os.path.join(self.directory, self.base, name), data):
+            self.written.append(self.base + name)
+        else:
+            self.unchanged.append(self.base + name)
+        self.files.append(name)
+        self.digests.append(contentstore.text_hash(data))
+
+    def close(self):
+
+        """Write term shards and the index file, remove shards of the previous build
+        """
+
+        self._close_docs()
+        shards = {}
+        for term in self.postings:
+            shards.setdefault(shard_key(term), []).append(term)
+        for key in sorted(shards):
+            data = json.dumps(dict((term, self.postings[term]) for term in sorted(shards[key])),
+                              ensure_ascii=False, separators=(",", ":"))
+            self._write(shard_name(key), "tipuesearch_shard(" + json.dumps(key, ensure_ascii=False) + ", " + data + ");")
+        keep = set(self.files)
+        for name in sorted(os.listdir(os.path.join(self.directory, self.base))):
+            if name.endswith(".js") and name not in keep:
+                os.remove(os.path.join(self.directory, self.base, name))
+                self.deleted.append(self.base + name)
+        # 頁面 id 隨內容改變, 以所有 shard 的 hash 作為版本, 避免瀏覽器混用新舊 shard
+        version = contentstore.text_hash("".join(self.digests))[:12]
+        index = {"version": version, "pages": self.count, "docs": self.docs, "base": self.base}
+        data = "var tipuesearch_index = " + json.dumps(index, ensure_ascii=False) + ";"
+        if write_if_changed(os.path.join(self.directory, self.index_name), data):
+            self.written.append(self.index_name)
+        else:
+            self.unchanged.append(self.index_name)
+        return version
@@ -74,6 +74,23 @@ http://www.tipue.com/search
                
 
                function getTipueSearch(start, replace)
+               {
+                    // 使用 cmsimde 分片索引時, 先載入查詢所需的 shard 與頁面再搜尋
+                    if (typeof tipuesearch_index != 'undefined')
+                    {
+                         tipuesearch_prepare($('#tipue_search_input').val(), function()
+                         {
+                              searchTipue(start, replace);
+                         });
+                    }
+                    else
+                    {
+                         searchTipue(start, replace);
+                    }
+               }
+
+
+               function searchTipue(start, replace)
                {
                     window.scrollTo(0, 0);
                     
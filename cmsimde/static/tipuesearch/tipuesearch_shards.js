@@ -0,0 +1,237 @@
+
+/*
+Lazily loaded sharded index for Tipue Search, written by cmsimde/searchindex.py
+
+tipuesearch_index.js 只記錄版本與頁數, 搜尋時才由 tipuesearch/ 載入查詢字詞所在的 shard,
+再載入可能符合的頁面內容, 交給 Tipue 以原本的方式計分與顯示
+*/
+
+
+var tipuesearch = {"pages": []};
+var tipuesearch_shards = {};
+var tipuesearch_doc_shards = {};
+var tipuesearch_requested = {};
+
+// 與 searchindex.py 相同的字詞切割: 中日韓文字逐字, 其他文字以連續的字母與數字為一個字詞
+var tipuesearch_cjk = '\u2e80-\u2fdf\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff';
+var tipuesearch_cjk_term = new RegExp('^[' + tipuesearch_cjk + ']$');
+var tipuesearch_term = new RegExp('[' + tipuesearch_cjk + ']|(?:(?![' + tipuesearch_cjk + '])[\\p{L}\\p{N}])+', 'gu');
+
+
+function tipuesearch_shard(key, terms)
+{
+     tipuesearch_shards[key] = terms;
+}
+
+
+function tipuesearch_docs(n, pages)
+{
+     tipuesearch_doc_shards[n] = pages;
+}
+
+
+function tipuesearch_shard_key(term)
+{
+     if (tipuesearch_cjk_term.test(term))
+     {
+          return term;
+     }
+     return Array.from(term).slice(0, 2).join('');
+}
+
+
+function tipuesearch_shard_name(key)
+{
+     return 't_' + Array.from(key).map(function(c) { return c.codePointAt(0).toString(16); }).join('_');
+}
+
+
+function tipuesearch_url(name)
+{
+     return tipuesearch_index.base + name + '.js?v=' + tipuesearch_index.version;
+}
+
+
+// 以 script 載入各網址, file:// 開啟的靜態網頁也可使用, 全部載入或失敗後呼叫 done
+function tipuesearch_load(urls, done)
+{
+     var pending = 1;
+     function finished()
+     {
+          pending--;
+          if (pending == 0)
+          {
+               done();
+          }
+     }
+     $.each(urls, function(i, url)
+     {
+          var state = tipuesearch_requested[url];
+          if (state === true)
+          {
+               return;
+          }
+          pending++;
+          if (state)
+          {
+               state.push(finished);
+               return;
+          }
+          tipuesearch_requested[url] = [finished];
+          var script = document.createElement('script');
+          script.src = url;
+          script.onload = script.onerror = function()
+          {
+               var callbacks = tipuesearch_requested[url];
+               tipuesearch_requested[url] = true;
+               for (var k = 0; k < callbacks.length; k++)
+               {
+                    callbacks[k]();
+               }
+          };
+          document.head.appendChild(script);
+     });
+     finished();
+}
+
+
+// 傳回包含 term 的頁面, 非中日韓字詞以字首比對
+function tipuesearch_postings(term)
+{
+     var shard = tipuesearch_shards[tipuesearch_shard_key(term)] || {};
+     if (tipuesearch_cjk_term.test(term))
+     {
+          return shard[term] || [];
+     }
+     var docs = [];
+     for (var t in shard)
+     {
+          if (t.indexOf(term) == 0)
+          {
+               docs = docs.concat(shard[t]);
+          }
+     }
+     return docs;
+}
+
+
+// 依查詢字串設定 tipuesearch.pages 為可能符合的頁面, 完成後呼叫 done
+function tipuesearch_prepare(query, done)
+{
+     var d = $.trim(query.toLowerCase().replace(/\+/g, ' '));
+     var words;
+     if ((d.match("^\"") && d.match("\"$")) || (d.match("^'") && d.match("'$")))
+     {
+          words = [d.substring(1, d.length - 1)];
+     }
+     else
+     {
+          words = d.split(/\s+/);
+          // Tipue 會以 tipuesearch_set.js 中的替換字與字根一起搜尋
+          var extra = [];
+          for (var i = 0; i < words.length; i++)
+          {
+               for (var f = 0; f < tipuesearch_replace.words.length; f++)
+               {
+                    if (words[i] == tipuesearch_replace.words[f].word)
+                    {
+                         extra.push(tipuesearch_replace.words[f].replace_with);
+                    }
+               }
+               for (var f = 0; f < tipuesearch_stem.words.length; f++)
+               {
+                    if (words[i] == tipuesearch_stem.words[f].word)
+                    {
+                         extra.push(tipuesearch_stem.words[f].stem);
+                    }
+               }
+          }
+          words = words.concat(extra);
+     }
+     var all = false;
+     var groups = [];
+     var urls = [];
+     for (var i = 0; i < words.length; i++)
+     {
+          if (words[i] == '' || words[i].match('^-'))
+          {
+               continue;
+          }
+          var terms = $.grep(words[i].match(tipuesearch_term) || [], function(term)
+          {
+               return tipuesearch_cjk_term.test(term) || Array.from(term).length > 1;
+          });
+          // 無法由索引縮小範圍的字詞, 必須載入全部頁面
+          if (terms.length == 0)
+          {
+               all = true;
+               continue;
+          }
+          groups.push(terms);
+          for (var k = 0; k < terms.length; k++)
+          {
+               urls.push(tipuesearch_url(tipuesearch_shard_name(tipuesearch_shard_key(terms[k]))));
+          }
+     }
+     tipuesearch_load(all ? [] : urls, function()
+     {
+          var docs = {};
+          var shards = {};
+          if (all)
+          {
+               for (var n = 0; n < tipuesearch_index.pages; n++)
+               {
+                    docs[n] = true;
+               }
+          }
+          else
+          {
+               // 同一查詢字詞的各字詞必須同時出現, 不同查詢字詞則任一符合即可
+               for (var i = 0; i < groups.length; i++)
+               {
+                    var found = null;
+                    for (var k = 0; k < groups[i].length; k++)
+                    {
+                         var current = {};
+                         var postings = tipuesearch_postings(groups[i][k]);
+                         for (var p = 0; p < postings.length; p++)
+                         {
+                              if (found === null || found[postings[p]])
+                              {
+                                   current[postings[p]] = true;
+                              }
+                         }
+                         found = current;
+                    }
+                    $.extend(docs, found);
+               }
+          }
+          var ids = [];
+          for (var id in docs)
+          {
+               ids.push(parseInt(id));
+               shards[Math.floor(id / tipuesearch_index.docs)] = true;
+          }
+          ids.sort(function(a, b) { return a - b });
+          var doc_urls = [];
+          for (var n in shards)
+          {
+               doc_urls.push(tipuesearch_url('d_' + n));
+          }
+          tipuesearch_load(doc_urls, function()
+          {
+               var pages = [];
+               for (var i = 0; i < ids.length; i++)
+               {
+                    var shard = tipuesearch_doc_shards[Math.floor(ids[i] / tipuesearch_index.docs)];
+                    if (shard)
+                    {
+                         pages.push(shard[ids[i] % tipuesearch_index.docs]);
+                    }
+               }
+               tipuesearch = {"pages": pages};
+               done();
+          });
+     });
+}
+
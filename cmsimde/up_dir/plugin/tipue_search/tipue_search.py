@@ -12,6 +12,7 @@ Copyright (c) Talha Mansoor
 from __future__ import unicode_literals
 
 import os.path
+import sys
 import json
 from bs4 import BeautifulSoup
 from codecs import open
@@ -22,6 +23,10 @@ except ImportError:
 
 from pelican import signals
 
+# 分片搜尋索引與 cmsimde 靜態網頁共用 cmsimde/searchindex.py, plugin 與 cmsimde 目錄同在網站根目錄下
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'cmsimde'))
+import searchindex
+
 
 class Tipue_Search_JSON_Generator(object):
 
@@ -115,6 +120,12 @@ class Tipue_Search_JSON_Generator(object):
             fd.write(search_text)
             fd.write(';')
 
+        # 以下寫出依字詞分片的索引, 搜尋時只需載入 tipuesearch_index.js 與查詢所需的 shard
+        index = searchindex.IndexWriter(self.output_path)
+        for node in self.json_nodes:
+            index.add(node)
+        index.close()
+
 def get_generators(generators):
     return Tipue_Search_JSON_Generator
 
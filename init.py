@@ -14,6 +14,20 @@ class Init(object):
     ip = "127.0.0.1"
     dynamic_port = 9443
     static_port = 8443
+    # 頁面儲存方式: "htm" 使用 config/content.htm, "shard" 將各頁面分存於 config/pages/, "sqlite" 存於 config/content.db 並以 FTS5 建立搜尋索引
+    content_store = "htm"
+    # config/content_journal.jsonl 保留的修改記錄筆數, 可用 python3 cmsimde/flaskapp.py undo 逐一回復
+    journal_keep = 200
+    # 已產生頁面內容的快取記憶體上限 (bytes), 設為 0 則不快取
+    page_cache_size = 32 * 1024 * 1024
+    # python3 -m cmsimde build 轉為靜態網頁時平行處理的程序數, 0 表示使用全部 CPU, 動態網站的 generate_pages 只使用一個程序
+    generate_jobs = 1
+    # 靜態網頁選單, "inline" 寫入各頁面, "external" 則各頁面共用 content/menu-*.js
+    static_menu = "inline"
+    # 動態網站的 request 統計, "off" 不記錄, "basic" 低負擔可長期開啟, "full" 另計算串流回應大小並計時至回應送出
+    metrics = "basic"
+    # 管理者登入或以 Authorization: Bearer metrics_token 取得 /metrics, 空字串則只允許管理者
+    metrics_token = ""
     def __init__(self):
         # hope to create downloads and images directories　
         if not os.path.isdir(_curdir + "/downloads"):
@@ -113,6 +113,24 @@ http://www.tipue.com/search
                
 
                function getTipueSearch(start, replace)
+               {
+                    // 使用 cmsimde 分片索引時, 先載入查詢所需的 shard 與頁面再搜尋
+                    if (typeof tipuesearch_index != 'undefined')
+                    {
+                         tipuesearch_prepare($('#tipue_search_input').val(), function()
+                         {
+                              tipuesearch_in = $.extend({}, tipuesearch);
+                              searchTipue(start, replace);
+                         });
+                    }
+                    else
+                    {
+                         searchTipue(start, replace);
+                    }
+               }
+
+
+               function searchTipue(start, replace)
                {
                     $('#tipue_search_content').hide();
                     $('#tipue_search_content').html('<div class="tipue_search_spinner"><div class="tipue_search_rect1"></div><div class="tipue_search_rect2"></div><div class="rect3"></div></div>');